@@ -4,6 +4,7 @@ import os
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
 DATASET_DIRNAME = "data"  # 数据集放在根目录的data文件夹下
+CACHE_DIRNAME = "cache"  # 缓存文件放在根目录的cache文件夹下
 
 # 确定文件名正确
 RT_MATRIX_NAME = "rtMatrix.txt"
@@ -12,12 +13,18 @@ USERS_NAME = "userlist.txt"
 WSLIST_NAME = "wslist.txt"
 
 DATASET_DIR = os.path.join(BASE_DIR, DATASET_DIRNAME)
+CACHE_DIR = os.path.join(BASE_DIR, CACHE_DIRNAME)
 
 RT_MATRIX_DIR = os.path.join(DATASET_DIR, RT_MATRIX_NAME)
 TP_MATRIX_DIR = os.path.join(DATASET_DIR, TP_MATRIX_NAME)
 USER_DIR = os.path.join(DATASET_DIR, USERS_NAME)
 WS_DIR = os.path.join(DATASET_DIR, WSLIST_NAME)
 
-__all__ = ["RT_MATRIX_DIR", "TP_MATRIX_DIR", "USER_DIR", "WS_DIR"]
-
+MATRIX_CACHE_DIR = os.path.join(CACHE_DIR, "matrix")  # rtMatrix/tpMatrix的二进制缓存
+SIMILARITY_CACHE_DIR = os.path.join(CACHE_DIR,
+                                    "similarity")  # 相似度矩阵和近邻索引的缓存
 
+__all__ = [
+    "RT_MATRIX_DIR", "TP_MATRIX_DIR", "USER_DIR", "WS_DIR", "CACHE_DIR",
+    "MATRIX_CACHE_DIR", "SIMILARITY_CACHE_DIR"
+]
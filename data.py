@@ -1,6 +1,6 @@
+import hashlib
 import os
 import random
-from copy import deepcopy
 from functools import wraps
 
 import numpy as np
@@ -14,6 +14,68 @@ from tqdm import tqdm
 from const import *
 from utils.decorator import cache4method
 from utils.preprocess import l2_norm, min_max_scaler, z_score
+from utils.tools import input_json, output_json
+
+MATRIX_CACHE_VERSION = 1  # 二进制缓存的格式版本, 格式变化时递增, 旧缓存会自动重建
+
+
+def _file_sha1(file_path, chunk_size=1 << 20):
+    sha1 = hashlib.sha1()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def load_matrix_cache(txt_path, cache_dir=MATRIX_CACHE_DIR):
+    """以内存映射的方式读取QoS矩阵
+
+    第一次读取时将txt矩阵解析并转存为.npy二进制文件, 同时记录格式版本和源文件的sha1,
+    之后直接使用np.memmap打开, 多个进程可以共享同一份物理内存页.
+    源文件大小或修改时间变化时重新校验sha1, 校验不通过则重建缓存.
+
+    Args:
+        txt_path : rtMatrix.txt / tpMatrix.txt 的路径
+        cache_dir : 缓存文件的存放目录. Defaults to MATRIX_CACHE_DIR.
+
+    Returns:
+        np.memmap: 只读的QoS矩阵
+    """
+    name = os.path.splitext(os.path.basename(txt_path))[0]
+    npy_path = os.path.join(cache_dir, f"{name}.npy")
+    meta_path = os.path.join(cache_dir, f"{name}.json")
+    stat = os.stat(txt_path)
+
+    meta = input_json(meta_path)
+    if meta is not None and meta.get("version") == MATRIX_CACHE_VERSION \
+            and os.path.isfile(npy_path):
+        if meta["size"] == stat.st_size and meta["mtime"] == stat.st_mtime_ns:
+            return np.load(npy_path, mmap_mode="r")
+        # 大小或修改时间变化(例如重新拷贝了数据集), 以sha1为准
+        sha1 = _file_sha1(txt_path)
+        if meta["sha1"] == sha1:
+            meta.update(size=stat.st_size, mtime=stat.st_mtime_ns)
+            output_json(meta, meta_path)
+            return np.load(npy_path, mmap_mode="r")
+
+    os.makedirs(cache_dir, exist_ok=True)
+    data = np.loadtxt(txt_path)
+    # 先写临时文件再替换, 避免多个进程同时建缓存时读到不完整的文件
+    tmp_path = f"{npy_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.save(f, data)
+    os.replace(tmp_path, npy_path)
+    meta = {
+        "version": MATRIX_CACHE_VERSION,
+        "source": os.path.abspath(txt_path),
+        "sha1": _file_sha1(txt_path),
+        "size": stat.st_size,
+        "mtime": stat.st_mtime_ns,
+        "shape": list(data.shape),
+        "dtype": str(data.dtype)
+    }
+    output_json(meta, meta_path)
+    return np.load(npy_path, mmap_mode="r")
 
 
 class ToTorchDataset(Dataset):
@@ -34,6 +96,68 @@ class ToTorchDataset(Dataset):
             index], self.target_tensor[index]
 
 
+class TensorBatchLoader(object):
+    """基于张量切片的批量读取, 用来替代 ToTorchDataset + DataLoader
+
+    user/item/rate各保存为一个连续的张量(由torch.from_numpy构建, 不再逐条转换和collate),
+    每个batch是这三个张量的切片. shuffle为True时每个epoch只做一次随机排列.
+    可以直接传给ModelBase.fit/predict以及联邦客户端的训练.
+
+    Args:
+        triad : 三元组(uid, iid, rate), 也可以是每一项为特征下标列表的三元组(例如FedXXX的p_triad)
+        batch_size : batch大小. Defaults to 64.
+        shuffle : 每个epoch是否打乱数据. Defaults to False.
+        drop_last : 是否丢弃最后一个不完整的batch. Defaults to False.
+        device : 张量存放的设备, 例如"cuda", None表示CPU. Defaults to None.
+    """
+    def __init__(self,
+                 triad,
+                 batch_size=64,
+                 shuffle=False,
+                 drop_last=False,
+                 device=None) -> None:
+        super().__init__()
+        assert batch_size > 0
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.user_tensor = self._column(triad, 0, np.int64)
+        self.item_tensor = self._column(triad, 1, np.int64)
+        self.target_tensor = self._column(triad, 2, np.float32)
+        if device is not None:
+            self.user_tensor = self.user_tensor.to(device)
+            self.item_tensor = self.item_tensor.to(device)
+            self.target_tensor = self.target_tensor.to(device)
+
+    @staticmethod
+    def _column(triad, idx, dtype):
+        if isinstance(triad, np.ndarray) and triad.dtype != object:
+            column = triad[:, idx]
+        else:
+            column = np.array([row[idx] for row in triad])
+        return torch.from_numpy(np.ascontiguousarray(column, dtype=dtype))
+
+    @property
+    def n_samples(self):
+        return len(self.target_tensor)
+
+    def __len__(self):
+        """batch的数量, 与DataLoader相同
+        """
+        if self.drop_last:
+            return self.n_samples // self.batch_size
+        return (self.n_samples + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        users, items, rates = self.user_tensor, self.item_tensor, self.target_tensor
+        if self.shuffle:
+            perm = torch.randperm(self.n_samples, device=users.device)
+            users, items, rates = users[perm], items[perm], rates[perm]
+        for k in range(len(self)):
+            batch = slice(k * self.batch_size, (k + 1) * self.batch_size)
+            yield users[batch], items[batch], rates[batch]
+
+
 class DatasetBase(object):
     """
     指定要使用的数据集
@@ -41,18 +165,21 @@ class DatasetBase(object):
     tp: tpMatrix
     user: userlist
     service: wslist
+
+    use_cache为True时rt/tp矩阵通过二进制缓存以内存映射的方式读取(只读)
     """
-    def __init__(self, type_) -> None:
+    def __init__(self, type_, use_cache=True) -> None:
         super().__init__()
 
         self.type = type_
+        self.use_cache = use_cache
         assert self.type in ["rt", "tp", "user", "service"], f"类型不符，请在{['rt', 'tp', 'user', 'service']}中选择"
 
     def get_row_data(self):
         if self.type == "rt":
-            data = np.loadtxt(RT_MATRIX_DIR)
+            data = load_matrix_cache(RT_MATRIX_DIR) if self.use_cache else np.loadtxt(RT_MATRIX_DIR)
         elif self.type == "tp":
-            data = np.loadtxt(TP_MATRIX_DIR)
+            data = load_matrix_cache(TP_MATRIX_DIR) if self.use_cache else np.loadtxt(TP_MATRIX_DIR)
         elif self.type == "user":
             data = pd.read_csv(USER_DIR, sep="\t")
         elif self.type == "service":
@@ -106,8 +233,8 @@ class InfoDataset(DatasetBase):
 
 
 class MatrixDataset(DatasetBase):
-    def __init__(self, type_) -> None:
-        super().__init__(type_)
+    def __init__(self, type_, use_cache=True) -> None:
+        super().__init__(type_, use_cache)
         assert type_ in ["rt", "tp"], f"类型不符，请在{['rt','tp']}中选择"
         self.matrix = self._get_row_data()
         self.scaler = None
@@ -128,6 +255,25 @@ class MatrixDataset(DatasetBase):
         self.row_n, self.col_n = data.shape
         return data
 
+    def _nonzero_index(self, nan_symbol=-1):
+        """返回所有有效评分(非缺失且非0)的行列下标, 顺序与np.nonzero一致
+        """
+        return np.nonzero((self.matrix != nan_symbol) & (self.matrix != 0))
+
+    def get_triad_columns(self, nan_symbol=-1):
+        """向量化地生成三元组的三列
+
+        Args:
+            nan_symbol (int, optional): 数据集中用于表示数据缺失的值. Defaults to -1.
+
+        Returns:
+            tuple: (uid int32, iid int32, rate float32)
+        """
+        uid, iid = self._nonzero_index(nan_symbol)
+        rate = self.matrix[uid, iid]
+        return uid.astype(np.int32), iid.astype(np.int32), rate.astype(
+            np.float32)
+
     def get_triad(self, nan_symbol=-1):
         """生成三元组(uid,iid,rate)
 
@@ -135,16 +281,10 @@ class MatrixDataset(DatasetBase):
             nan_symbol (int, optional): 数据集中用于表示数据缺失的值. Defaults to -1.
 
         Returns:
-            list[list]: (uid,iid,rate)
+            np.ndarray: (uid,iid,rate)
         """
-        triad_data = []
-        row_data = deepcopy(self.matrix)
-
-        row_data[row_data == nan_symbol] = 0
-        non_zero_index_tuple = np.nonzero(row_data)
-        for uid, iid in zip(non_zero_index_tuple[0], non_zero_index_tuple[1]):
-            triad_data.append([uid, iid, row_data[uid, iid]])
-        triad_data = np.array(triad_data)
+        uid, iid = self._nonzero_index(nan_symbol)
+        triad_data = np.column_stack((uid, iid, self.matrix[uid, iid]))
         print("triad_data size:", triad_data.shape)
         return triad_data
 
@@ -153,13 +293,23 @@ class MatrixDataset(DatasetBase):
                          nan_symbol=-1,
                          shuffle=True,
                          normalize_type=None):
-        triad_data = self.get_triad(nan_symbol)
+        uid, iid = self._nonzero_index(nan_symbol)
+        print("triad_data size:", (len(uid), 3))
 
+        # 只打乱下标, 不打乱整个三元组; 与对三元组调用np.random.shuffle的结果一致
         if shuffle:
-            np.random.shuffle(triad_data)
+            index = np.random.permutation(len(uid))
+        else:
+            index = np.arange(len(uid))
 
         train_n = int(self.row_n * self.col_n * density)  # 训练集数量
-        train_data, test_data = triad_data[:train_n], triad_data[train_n:]
+        train_index, test_index = index[:train_n], index[train_n:]
+        train_data = np.column_stack(
+            (uid[train_index], iid[train_index],
+             self.matrix[uid[train_index], iid[train_index]]))
+        test_data = np.column_stack(
+            (uid[test_index], iid[test_index],
+             self.matrix[uid[test_index], iid[test_index]]))
         if normalize_type is not None:
             self.__norm_train_test_data(train_data, test_data, normalize_type)
 
@@ -30,6 +30,11 @@ class Client(object):
             l.append([iid, item_grad])
         return l
 
+    def fold_in_stats(self, rate):
+        """新服务fold-in时客户端上传的统计量: (u u^T, rate * u), 不直接上传user_vec
+        """
+        return np.outer(self.user_vec, self.user_vec), rate * self.user_vec
+
 
 class Clients(object):
 
@@ -50,8 +55,61 @@ class Clients(object):
         for uid, rows in r.items():
             self.clients_map[uid] = Client(np.array(rows), uid,
                                            self.users_vec[uid])
+        self._build_arrays()
         print(f"Clients Nums:{len(self.clients_map)}")
 
+    def _build_arrays(self):
+        """向量化训练使用的数据: 所有client的数据按client顺序拼接, 以及每个client数据的起点和条数
+        """
+        triads = [client.triad for _, client in self]
+        flat = np.concatenate(triads) if triads else np.empty((0, 3))
+        self.flat_uids = flat[:, 0].astype(np.int64)
+        self.flat_iids = flat[:, 1].astype(np.int64)
+        self.flat_rates = flat[:, 2].astype(np.float64)
+        self.counts = np.array([len(t) for t in triads], dtype=np.int64)
+        self.starts = np.concatenate(([0], np.cumsum(self.counts)[:-1]))
+
+    def fit(self, items_vec, lambda_, lr):
+        """所有client同步(lockstep)地训练一轮, 与依次调用每个Client.fit的结果相同
+
+        一轮中项目特征矩阵保持不变, 各client之间互不影响, 只有同一个client的数据需要按顺序处理.
+        因此第k步同时处理每个client的第k条数据, 用数组运算代替逐条的循环.
+
+        Returns:
+            (iids, item_grads): 按client顺序和数据顺序排列的物品id及其梯度(矩阵)
+        """
+        item_grads = np.empty((len(self.flat_iids), items_vec.shape[1]))
+        n_steps = self.counts.max() if len(self.counts) else 0
+        for k in range(n_steps):
+            idx = self.starts[self.counts > k] + k
+            uids, iids = self.flat_uids[idx], self.flat_iids[idx]
+            user_vec, item_vec = self.users_vec[uids], items_vec[iids]
+            # 与逐条计算 user_vec @ item_vec.T 的结果逐位一致
+            y_pred = np.matmul(user_vec[:, None, :], item_vec[:, :, None])
+            e_ui = self.flat_rates[idx, None] - y_pred[:, 0]
+            user_grad = -2 * e_ui * item_vec + 2 * lambda_ * user_vec
+            item_grads[idx] = -2 * e_ui * user_vec + 2 * lambda_ * item_vec
+            self.users_vec[uids] = user_vec - lr * user_grad
+        return self.flat_iids, item_grads
+
+    def add_client(self, iids, rates, user_vec):
+        """加入一个新的客户端(新用户)
+
+        users_vec增加一行, 已有客户端的user_vec重新指向新数组中对应的行
+
+        Returns:
+            int: 新客户端的uid
+        """
+        uid = len(self.users_vec)
+        self.users_vec = np.vstack([self.users_vec, user_vec])
+        for cid, client in self.clients_map.items():
+            client.user_vec = self.users_vec[cid]
+        triad = np.column_stack([np.full(len(iids), uid), iids,
+                                 rates]).astype(np.float64)
+        self.clients_map[uid] = Client(triad, uid, self.users_vec[uid])
+        self._build_arrays()
+        return uid
+
     def __len__(self):
         return len(self.clients_map)
 
@@ -5,6 +5,7 @@ from root import absolute
 from tqdm import tqdm
 from utils import TNLog
 from utils.evaluation import mae, mse, rmse
+from utils.factorization import FactorScorer, fold_in
 
 from .client import Clients
 from .server import Server
@@ -19,19 +20,36 @@ class FedMF(object):
         self.logger = TNLog(self.name)
         self.logger.initial_logger()
 
-    def fit(self, epochs, lambda_, lr, test_triad, interval=10, scaler=None):
+    def fit(self,
+            epochs,
+            lambda_,
+            lr,
+            test_triad,
+            interval=10,
+            scaler=None,
+            vectorized=True):
+        """训练模型
+
+        Args:
+            vectorized : 是否使用向量化的模拟(Clients.fit + Server.upgrade_arrays), 结果与逐个client训练相同
+        """
         best_mae = None
         is_better = True
         for epoch in tqdm(range(epochs), desc="Epochs"):
-            gradient_from_user = []
-            # 遍历每一个用户
-            for client_id, client in self.clients:
-                # client upgrade
-                gradient_from_user.extend(
-                    client.fit(self.server.items_vec, lambda_, lr))
+            if vectorized:
+                iids, grads = self.clients.fit(self.server.items_vec,
+                                               lambda_, lr)
+                self.server.upgrade_arrays(lr, iids, grads)
+            else:
+                gradient_from_user = []
+                # 遍历每一个用户
+                for client_id, client in self.clients:
+                    # client upgrade
+                    gradient_from_user.extend(
+                        client.fit(self.server.items_vec, lambda_, lr))
 
-            # server upgrade
-            self.server.upgrade(lr, gradient_from_user)
+                # server upgrade
+                self.server.upgrade(lr, gradient_from_user)
 
             if (epoch + 1) % interval == 0:
                 y_list, y_pred_list = self.predict(test_triad, scaler=scaler)
@@ -62,10 +80,42 @@ class FedMF(object):
         else:
             print("Not improved")
 
+    def fold_in_user(self, iids, rates, lambda_):
+        """新用户作为新的客户端加入: 固定服务端的项目特征矩阵, 在本地求解用户特征向量
+
+        Args:
+            iids : 新用户调用过的服务id
+            rates : 对应的QoS值
+            lambda_ : 正则化系数, 与训练时相同
+
+        Returns:
+            int: 新用户的uid
+        """
+        vec = fold_in(self.server.items_vec, iids, rates, lambda_)
+        return self.clients.add_client(iids, rates, vec)
+
+    def fold_in_item(self, uids, rates, lambda_):
+        """新服务加入: 调用过该服务的客户端上传统计量, 服务端求解项目特征向量
+
+        Args:
+            uids : 调用过新服务的用户id
+            rates : 对应的QoS值
+            lambda_ : 正则化系数, 与训练时相同
+
+        Returns:
+            int: 新服务的iid
+        """
+        stats = [
+            self.clients[int(uid)].fold_in_stats(rate)
+            for uid, rate in zip(uids, rates)
+        ]
+        return self.server.fold_in_item(stats, lambda_)
+
     def load_checkpoint(self, user_vec_path, item_vec_path):
-        users_vec = np.load(user_vec_path)
-        items_vec = np.load(item_vec_path)
-        return users_vec, items_vec
+        """以内存映射的方式读取保存的特征矩阵
+        """
+        scorer = FactorScorer.from_npy(user_vec_path, item_vec_path)
+        return scorer.user_vec, scorer.item_vec
 
     def predict(self,
                 triad,
@@ -74,30 +124,29 @@ class FedMF(object):
                 item_vec_path=None,
                 scaler=None):
 
-        y_list = []
-        y_pred_list = []
-
         if resume:
-            users_vec, items_vec = self.load_checkpoint(
-                user_vec_path, item_vec_path)
-            for row in tqdm(triad, desc="Test"):
-                uid, iid, rate = int(row[0]), int(row[1]), float(row[2])
-                y_pred = users_vec[uid] @ items_vec[iid].T
-                y_list.append(rate)
-                y_pred_list.append(y_pred)
+            scorer = FactorScorer.from_npy(user_vec_path, item_vec_path)
         else:
-            for row in tqdm(triad, desc="Test"):
-                uid, iid, rate = int(row[0]), int(row[1]), float(row[2])
-                y_pred = self.clients[uid].user_vec @ self.server.items_vec[
-                    iid].T
-                y_list.append(rate)
-                y_pred_list.append(y_pred)
+            # 每个客户端的user_vec是clients.users_vec中对应行的视图
+            scorer = FactorScorer(self.clients.users_vec,
+                                  self.server.items_vec)
+        y_list, y_pred_list = scorer.predict(triad)
 
         if scaler is not None:
-            y_list = np.array(y_list, dtype=np.float)
-            y_pred_list = np.array(y_pred_list, dtype=np.float)
-
             y_list = scaler.inverse_transform(y_list)
             y_pred_list = scaler.inverse_transform(y_pred_list)
 
         return y_list, y_pred_list
+
+    def recommend(self,
+                  uids,
+                  k=10,
+                  exclude=None,
+                  candidates=None,
+                  largest=False):
+        """Top-N服务推荐, 使用客户端的用户特征和服务端的项目特征
+
+        参数和返回值见FactorScorer.top_n
+        """
+        scorer = FactorScorer(self.clients.users_vec, self.server.items_vec)
+        return scorer.top_n(uids, k, exclude, candidates, largest)
@@ -17,3 +17,32 @@ class Server(object):
         for gradient in gradient_from_user:
             iid, grad = gradient[0], gradient[1]
             self.items_vec[iid] -= lr * grad
+
+    def upgrade_arrays(self, lr, iids, grads):
+        """Server upgrades by user gradient given as (iid array, grad matrix)
+
+        np.subtract.at按顺序累加同一物品的多个梯度, 与upgrade逐条更新的结果相同
+        """
+        np.subtract.at(self.items_vec, iids, lr * grads)
+
+    def fold_in_item(self, stats, lambda_):
+        """用客户端上传的统计量求解新服务的特征向量(岭回归), 并加入项目特征矩阵
+
+        Args:
+            stats : [(u u^T, rate * u)], 每个调用过新服务的客户端一项
+            lambda_ : 正则化系数
+
+        Returns:
+            int: 新服务的iid
+        """
+        vec = np.zeros(self.latent_dim)
+        if len(stats) > 0:
+            a = lambda_ * len(stats) * np.eye(self.latent_dim)
+            b = np.zeros(self.latent_dim)
+            for outer, weighted_vec in stats:
+                a += outer
+                b += weighted_vec
+            vec = np.linalg.solve(a, b)
+        self.items_vec = np.vstack([self.items_vec, vec])
+        self.n_item += 1
+        return self.n_item - 1
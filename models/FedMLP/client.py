@@ -1,11 +1,9 @@
-import copy
 from collections import OrderedDict, defaultdict
 
 import numpy as np
 import torch
-from data import ToTorchDataset
+from data import TensorBatchLoader
 from models.base import ClientBase, ClientsBase
-from torch.utils.data import DataLoader
 from tqdm import tqdm
 from utils.model_util import (nonzero_user_mean, split_d_triad,
                               triad_to_matrix, use_optimizer)
@@ -28,8 +26,8 @@ class Client(ClientBase):
         self.loss_list = []
         self.n_item = len(triad)
         self.batch_size = batch_size if batch_size != -1 else self.n_item
-        self.data_loader = DataLoader(ToTorchDataset(self.triad),
-                                      batch_size=self.batch_size)
+        self.data_loader = TensorBatchLoader(self.triad,
+                                             batch_size=self.batch_size)
 
     def fit(self, params, loss_fn, optimizer: str, lr, epochs=5):
         return super().fit(params, loss_fn, optimizer, lr, epochs=epochs)
@@ -55,7 +53,7 @@ class Clients(ClientsBase):
             r[uid].append(triad_row)
         for uid, rows in tqdm(r.items(), desc="Building clients..."):
             self.clients_map[uid] = Client(rows, uid,
-                                           copy.deepcopy(self.model),
+                                           self.worker_models,
                                            self.device)
             self.client_nums_map[uid] = len(rows)
         print(f"Clients Nums:{len(self.clients_map)}")
@@ -5,6 +5,7 @@ from root import absolute
 from tqdm import tqdm
 from utils import TNLog
 from utils.evaluation import mae, mse, rmse
+from utils.factorization import FactorScorer
 
 from .client import Clients
 from .server import Server
@@ -64,9 +65,10 @@ class FedNMF(object):
             print("Not improved")
 
     def load_checkpoint(self, user_vec_path, item_vec_path):
-        users_vec = np.load(user_vec_path)
-        items_vec = np.load(item_vec_path)
-        return users_vec, items_vec
+        """以内存映射的方式读取保存的特征矩阵
+        """
+        scorer = FactorScorer.from_npy(user_vec_path, item_vec_path)
+        return scorer.user_vec, scorer.item_vec
 
     def predict(self,
                 triad,
@@ -74,24 +76,25 @@ class FedNMF(object):
                 user_vec_path=None,
                 item_vec_path=None):
 
-        y_list = []
-        y_pred_list = []
-
-        # 使用本地结果
         if resume:
-            users_vec, items_vec = self.load_checkpoint(
-                user_vec_path, item_vec_path)
-            for row in tqdm(triad, desc="Test"):
-                uid, iid, rate = int(row[0]), int(row[1]), float(row[2])
-                y_pred = users_vec[uid] @ items_vec[iid].T
-                y_list.append(rate)
-                y_pred_list.append(y_pred)
+            scorer = FactorScorer.from_npy(user_vec_path, item_vec_path)
         else:
-            for row in tqdm(triad, desc="Test"):
-                uid, iid, rate = int(row[0]), int(row[1]), float(row[2])
-                y_pred = self.clients[uid].user_vec @ self.server.items_vec[
-                    iid].T
-                y_list.append(rate)
-                y_pred_list.append(y_pred)
+            # 每个客户端的user_vec是clients.users_vec中对应行的视图
+            scorer = FactorScorer(self.clients.users_vec,
+                                  self.server.items_vec)
+        y_list, y_pred_list = scorer.predict(triad)
 
         return y_list, y_pred_list
+
+    def recommend(self,
+                  uids,
+                  k=10,
+                  exclude=None,
+                  candidates=None,
+                  largest=False):
+        """Top-N服务推荐, 使用客户端的用户特征和服务端的项目特征
+
+        参数和返回值见FactorScorer.top_n
+        """
+        scorer = FactorScorer(self.clients.users_vec, self.server.items_vec)
+        return scorer.top_n(uids, k, exclude, candidates, largest)
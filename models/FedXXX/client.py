@@ -1,12 +1,10 @@
-import copy
 from collections import OrderedDict, defaultdict
 from functools import partialmethod
 
 import numpy as np
 import torch
-from data import ToTorchDataset
-from models.base import ClientBase
-from torch.utils.data import DataLoader
+from data import TensorBatchLoader
+from models.base import ClientBase, WorkerModels
 from tqdm import tqdm
 from utils.model_util import (nonzero_user_mean, split_d_triad,
                               triad_to_matrix, use_optimizer)
@@ -28,24 +26,25 @@ class Client(ClientBase):
         self.n_item = len(triad)
         self.local_epochs = local_epochs
         self.batch_size = self.n_item if batch_size == -1 else batch_size
-        self.data_loader = DataLoader(ToTorchDataset(self.triad),
-                                      batch_size=self.batch_size,
-                                      drop_last=True)
-        self.single_batch = DataLoader(ToTorchDataset(self.triad),
-                                       batch_size=1,
-                                       drop_last=True)
+        self.data_loader = TensorBatchLoader(self.triad,
+                                             batch_size=self.batch_size,
+                                             drop_last=True)
+        self.single_batch = TensorBatchLoader(self.triad,
+                                              batch_size=1,
+                                              drop_last=True)
 
     def fit(self, params, loss_fn, optimizer: str, lr, epochs=5):
         return super().fit(params, loss_fn, optimizer, lr, epochs=epochs)
 
     def upload_feature(self, params):
-        self.model.load_state_dict(params)
-        self.model.eval()
+        model = self.model.get()
+        model.load_state_dict(params)
+        model.eval()
         with torch.no_grad():
             for batch_id, batch in enumerate(self.single_batch):
                 user, item, rating = batch[0].to(self.device), batch[1].to(
                     self.device), batch[2].to(self.device)
-                y_pred, u_feature, i_feature = self.model(user, item, True)
+                y_pred, u_feature, i_feature = model(user, item, True)
                 return u_feature[0]
 
 
@@ -61,10 +60,11 @@ class Clients(object):
         super().__init__()
         self.triad, self.p_triad = split_d_triad(d_triad)
         self.model = model
+        self.worker_models = WorkerModels(model)  # 所有client共享的工作模型
         self.device = device
         self.clients_map = {}  # 存储每个client的数据集
         self.clients_feature_map = OrderedDict()  # 存储每个client的feature
-        self.triad2matrix = triad_to_matrix(self.triad, -1)
+        self.triad2matrix = triad_to_matrix(self.triad, -1, sparse=True)
         self.u_mean = nonzero_user_mean(self.triad2matrix, -1)
         self.batch_size = batch_size
         self.local_epochs = local_epochs
@@ -81,7 +81,7 @@ class Clients(object):
             self.clients_map[uid] = Client(rows,
                                            uid,
                                            self.device,
-                                           copy.deepcopy(self.model),
+                                           self.worker_models,
                                            batch_size=self.batch_size,
                                            local_epochs=self.local_epochs)
         print(f"Clients Nums:{len(self.clients_map)}")
@@ -116,7 +116,7 @@ class Clients(object):
     def _query(self, uid, iid, type_="rate"):
         try:
             if type_ == "rate":
-                return self.triad2matrix[uid][iid]
+                return self.triad2matrix.get(uid, iid)
             elif type_ == "mean":
                 return self.u_mean[uid]
         except Exception:
@@ -2,12 +2,11 @@ import collections
 
 import numpy as np
 import torch
-from data import ToTorchDataset
+from data import TensorBatchLoader
 from models.base import FedModelBase
 from models.base.base import ModelBase
 from torch import nn
 from torch.optim.adam import Adam
-from torch.utils.data.dataloader import DataLoader
 from tqdm import tqdm
 from utils.decorator import timeit
 from utils.evaluation import mae, mse, rmse
@@ -191,8 +190,7 @@ class FedXXXLaunch(FedModelBase):
         y_pred_list = []
         y_list = []
         triad, p_triad = split_d_triad(d_triad)
-        p_triad_dataloader = DataLoader(ToTorchDataset(p_triad),
-                                        batch_size=2048)  # 这里可以优化 这样写不是很好
+        p_triad_dataloader = TensorBatchLoader(p_triad, batch_size=2048)
 
         def upcc():
 
@@ -42,5 +42,8 @@ class GMFModel(ModelBase):
     def parameters(self):
         return self.model.parameters()
 
+    def fold_in_embeddings(self, side):
+        return [getattr(self.model, f"embedding_{side}")]
+
     def __repr__(self) -> str:
         return str(self.model)
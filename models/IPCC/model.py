@@ -1,8 +1,11 @@
-import copy
 import math
 import numpy as np
 from tqdm import tqdm
 from utils.model_util import triad_to_matrix, nonzero_user_mean, nonzero_item_mean
+from utils.similarity_cache import SimilarityCache
+from utils.similarity import (DEFAULT_N_NEIGHBORS, DEFAULT_PREDICT_BATCH_SIZE,
+                              NeighborIndex, pcc_similarity,
+                              weighted_deviation)
 
 # 相似度计算库
 from scipy.stats import pearsonr
@@ -16,34 +19,51 @@ class IPCCModel(object):
         self.u_mean = None  # 每个用户的评分均值（用于计算修正的余弦相似度）
         self.i_mean = None  # 每个项目的评分均值
         self.similarity_matrix = None  # 项目相似度矩阵
+        self.neighbor_index = None  # 每个项目的前k个相似项目
         self._nan_symbol = -1  # 缺失项标记（数据集中使用-1表示缺失项）
 
-    def _get_similarity_matrix(self, matrix, metric):
+    def _get_similarity_matrix(self,
+                               matrix,
+                               metric,
+                               block_size=None,
+                               memory_budget=None,
+                               out=None,
+                               n_jobs=1):
         """获取项目相似度矩阵
 
         Args:
             matrix (): QoS矩阵
             metric (): 相似度计算方法, 可选参数: PCC(皮尔逊相关系数), COS(余弦相似度), ACOS(修正的余弦相似度)
+            block_size (): PCC按项目分块计算时每块的项目数, None表示根据memory_budget计算
+            memory_budget (): PCC分块计算的内存预算(字节)
+            out (): PCC结果的存放位置, 传入.npy文件路径时直接写入内存映射文件
+            n_jobs (): PCC计算使用的进程数, -1表示使用所有CPU核心
 
         """
-        _m = copy.deepcopy(matrix)
-        _m[_m == self._nan_symbol] = 0  # 将缺失项用0代替，以便之后计算
+        if metric == 'PCC':
+            # 分块、向量化计算, 结果与下面逐对计算的结果一致
+            return pcc_similarity(matrix.csc.T,
+                                  block_size=block_size,
+                                  memory_budget=memory_budget,
+                                  out=out,
+                                  n_jobs=n_jobs)
+
         n_items = matrix.shape[1]
         similarity_matrix = np.zeros((n_items, n_items))
 
         # 计算相似度矩阵
         for i in tqdm(range(n_items), desc="生成相似度矩阵"):
+            col_i = matrix.dense_col(i)  # 缺失项用0代替，以便之后计算
+            nonzero_i = matrix.item_col(i)[0]  # 有评分的用户下标
             for j in range(i + 1, n_items):
-                col_i = _m[:, i]
-                col_j = _m[:, j]
-                nonzero_i = np.nonzero(col_i)[0]  # 非0元素对应的下标
-                nonzero_j = np.nonzero(col_j)[0]
-                intersect = np.intersect1d(nonzero_i,
-                                           nonzero_j)  # 对项目i,j同时有评分的用户集合
+                nonzero_j = matrix.item_col(j)[0]
+                intersect = np.intersect1d(nonzero_i, nonzero_j,
+                                           assume_unique=True)  # 对项目i,j同时有评分的用户集合
 
                 if len(intersect) == 0:
                     sim = 0
                 else:
+                    col_j = matrix.dense_col(j)
                     # 依据指定的相似度计算方法计算项目i,j的相似度
                     try:
                         if metric == 'PCC':
@@ -68,24 +88,17 @@ class IPCCModel(object):
         return similarity_matrix
 
     def _get_similarity_items(self, iid, topk=-1):
-        """获取相似用户
+        """获取相似项目
 
         Args:
             iid (): 当前项目
             topk (): 相似项目数量, -1表示不限制数量
 
         Returns:
-            依照相似度从大到小排序, 与当前项目最为相似的前topk个相似项目
+            依照相似度从大到小排序, 与当前项目最为相似的前topk个相似项目及其相似度
 
         """
-        assert isinstance(topk, int)
-        ordered_sim_iid = (
-            -self.similarity_matrix[iid]).argsort()  # 按相似度从大到小排序后, 相似用户对应的索引
-        if topk == -1:
-            return ordered_sim_iid
-        else:
-            assert topk > 0
-            return ordered_sim_iid[:topk]
+        return self.neighbor_index.neighbors(iid, topk)
 
     def get_similarity(self, iid_a, iid_b):
         """传入两个uid，获取这两个用户的相似度
@@ -100,58 +113,105 @@ class IPCCModel(object):
 
         return self.similarity_matrix[iid_a][iid_b]
 
-    def fit(self, triad, metric='PCC'):
+    def fit(self,
+            triad,
+            metric='PCC',
+            block_size=None,
+            memory_budget=None,
+            out_path=None,
+            n_neighbors=DEFAULT_N_NEIGHBORS,
+            n_jobs=1,
+            use_cache=True):
         """训练模型
 
         Args:
             triad (): 数据三元组: (uid, iid, rating)
             metric (): 相似度计算方法, 可选参数: PCC(皮尔逊相关系数), COS(余弦相似度), ACOS(修正的余弦相似度)
+            block_size (): 计算相似度矩阵时每块的项目数, None表示根据memory_budget计算
+            memory_budget (): 计算相似度矩阵的内存预算(字节), 默认512MB
+            out_path (): 相似度矩阵保存为.npy内存映射文件的路径, None表示保存在内存中
+            n_neighbors (): 近邻索引中为每个项目保存的相似项目数量, 预测时topK不超过该值则不需要重新排序
+            n_jobs (): 计算PCC相似度矩阵使用的进程数, -1表示使用所有CPU核心, 结果与单进程一致
+            use_cache (): 是否使用相似度缓存, 相同的训练数据和相似度计算方法只计算一次相似度矩阵和近邻索引,
+                指定了out_path时不使用缓存
         """
-        self.matrix = triad_to_matrix(triad, self._nan_symbol)  # 数据三元组转QoS矩阵
+        self.matrix = triad_to_matrix(triad, self._nan_symbol,
+                                      sparse=True)  # 数据三元组转稀疏QoS矩阵
         self.u_mean = nonzero_user_mean(self.matrix,
                                         self._nan_symbol)  # 根据QoS矩阵计算每个用户的评分均值
         # FIXME 考虑i_mean为0的情况
         self.i_mean = nonzero_item_mean(self.matrix,
                                         self._nan_symbol)  # 根据QoS矩阵计算每个项目的评分均值
-        self.similarity_matrix = self._get_similarity_matrix(
-            self.matrix, metric)  # 根据QoS矩阵获取项目相似矩阵
+        if use_cache and out_path is None:
+            cache = SimilarityCache(triad, metric, self._nan_symbol, "item")
+            self.similarity_matrix = cache.similarity_matrix(
+                lambda path: self._get_similarity_matrix(
+                    self.matrix, metric, block_size, memory_budget, path,
+                    n_jobs))  # 读取或计算项目相似矩阵
+            self.neighbor_index = cache.neighbor_index(
+                self.similarity_matrix, n_neighbors,
+                memory_budget=memory_budget)  # 读取或构建每个项目的近邻索引
+        else:
+            self.similarity_matrix = self._get_similarity_matrix(
+                self.matrix, metric, block_size, memory_budget, out_path,
+                n_jobs)  # 根据QoS矩阵获取项目相似矩阵
+            self.neighbor_index = NeighborIndex.build(
+                self.similarity_matrix, n_neighbors,
+                memory_budget=memory_budget)  # 构建每个项目的近邻索引
+
+    def predict_batch(self,
+                      uids,
+                      iids,
+                      topK=-1,
+                      batch_size=DEFAULT_PREDICT_BATCH_SIZE):
+        """批量预测
 
-    def predict(self, triad, topK=-1):
-        y_list = []  # 真实评分
-        y_pred_list = []  # 预测评分
-        cold_boot_cnt = 0  # 冷启动统计
-
-        for row in tqdm(triad, desc="Predict... "):
-            uid, iid, rate = int(row[0]), int(row[1]), float(row[2])
-            # 冷启动: 新用户因为没有计算过相似用户, 因此无法预测评分
-            if iid + 1 > self.matrix.shape[1]:
-                cold_boot_cnt += 1
-                continue
+        Args:
+            uids (): 用户id数组
+            iids (): 项目id数组
+            topK (): 相似项目数量, -1表示不限制数量
+            batch_size (): 每次同时计算的预测数量
+
+        Returns:
+            (预测评分, 冷启动掩码), 冷启动的位置预测评分为nan
+        """
+        assert self.i_mean is not None, "Please fit first e.g. model.fit()"
+        uids = np.asarray(uids, dtype=np.int64)
+        iids = np.asarray(iids, dtype=np.int64)
+        # 冷启动: 新项目因为没有计算过相似项目, 因此无法预测评分
+        cold_start = iids >= self.matrix.shape[1]
+        y_pred = np.full(len(uids), np.nan)
+
+        for start in tqdm(range(0, len(uids), batch_size),
+                          desc="Predict... "):
+            end = min(start + batch_size, len(uids))
+            warm = np.nonzero(~cold_start[start:end])[0] + start
+            uid, iid = uids[warm], iids[warm]
             i_mean = self.i_mean[iid]
-            similarity_items = self._get_similarity_items(iid, topK)
-            up = 0  # 分子
-            down = 0  # 分母
-            # 对于当前项目的每一个相似项目
-            for sim_iid in similarity_items:
-                sim_item_rate = self.matrix[uid][sim_iid]  # 当前用户对相似项目的评分
-                similarity = self.get_similarity(iid, sim_iid)
-                # 如果当前用户对相似项目没有评分，则不进行计算
-                if sim_item_rate == self._nan_symbol:
-                    continue
-                up += similarity * (sim_item_rate - self.i_mean[sim_iid]
-                                    )  # 相似度 * (相似项目评分 - 相似项目评分均值)
-                down += similarity  # 相似度的绝对值
-
-            if down != 0:
-                y_pred = i_mean + up / down
-            else:
-                y_pred = 0
-
-            y_pred_list.append(y_pred)
-            y_list.append(rate)
-
-        print(f"cold boot :{cold_boot_cnt / len(triad) * 100:4f}%")
-        return y_list, y_pred_list
+            sim_iids, similarities = self.neighbor_index.batch_neighbors(
+                iid, topK)
+            sim_item_rates = self.matrix.get(uid[:, None],
+                                             sim_iids)  # 当前用户对相似项目的评分
+            # 如果当前用户对相似项目没有评分，则不进行计算
+            valid = (sim_iids >= 0) & (sim_item_rates != self._nan_symbol)
+            up, down = weighted_deviation(sim_iids, similarities,
+                                          sim_item_rates, self.i_mean, valid)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                y_pred[warm] = np.where(down != 0, i_mean + up / down, 0)
+
+        return y_pred, cold_start
+
+    def predict(self, triad, topK=-1):
+        """预测评分
+
+        Returns:
+            (真实评分, 预测评分), 不包括冷启动的三元组
+        """
+        triad = np.asarray(triad)
+        y_pred, cold_start = self.predict_batch(triad[:, 0], triad[:, 1],
+                                                topK)
+        print(f"cold boot :{cold_start.mean() * 100:4f}%")
+        return triad[~cold_start, 2].astype(np.float64), y_pred[~cold_start]
 
 
 def adjusted_cosine_similarity(x, y, intersect, u_mean):
@@ -31,10 +31,9 @@ for density in [0.05, 0.1, 0.15, 0.2]:
     rt_data = MatrixDataset(type_)
     train_data, test_data = rt_data.split_train_test(density)
 
-    imean = IPCCModel()
-    imean.fit(train_data, metric='PCC')
-
     topk = 500
+    imean = IPCCModel()
+    imean.fit(train_data, metric='PCC', n_neighbors=topk)  # 近邻索引覆盖预测用的topk
     y, y_pred = imean.predict(test_data, topk)
 
     mae_ = mae(y, y_pred)
@@ -0,0 +1,76 @@
+import os
+import time
+
+import numpy as np
+from data import MatrixDataset
+from utils.factorization import SGD_KERNELS, HogwildSGD, split_triad
+from utils.model_util import freeze_random
+"""
+    Hogwild并行SGD的吞吐量测试: 不同进程数下每秒训练的评分条数(ratings/s)
+    MF与NMF共用同一套并行训练, 结果按 kernel / 进程数 输出
+"""
+
+
+def init_vec(n_user, n_item, latent_dim, kernel):
+    if kernel == "nmf":
+        return (np.random.random((n_user, latent_dim)),
+                np.random.random((n_item, latent_dim)))
+    return (np.random.normal(0, 0.1, (n_user, latent_dim)),
+            np.random.normal(0, 0.1, (n_item, latent_dim)))
+
+
+def bench_serial(n_user, n_item, latent_dim, columns, kernel, epochs,
+                 **kwargs):
+    """单进程顺序训练的吞吐量, 作为对照
+    """
+    user_vec, item_vec = init_vec(n_user, n_item, latent_dim, kernel)
+    start = time.perf_counter()
+    for _ in range(epochs):
+        SGD_KERNELS[kernel](user_vec, item_vec, *columns, **kwargs)
+    return len(columns[2]) * epochs / (time.perf_counter() - start)
+
+
+def bench_hogwild(n_user, n_item, latent_dim, columns, kernel, epochs,
+                  n_jobs, **kwargs):
+    """Hogwild并行训练的吞吐量(不包括创建进程池的时间)
+    """
+    user_vec, item_vec = init_vec(n_user, n_item, latent_dim, kernel)
+    with HogwildSGD(user_vec,
+                    item_vec,
+                    *columns,
+                    kernel=kernel,
+                    n_jobs=n_jobs,
+                    seed=0,
+                    **kwargs) as hogwild:
+        start = time.perf_counter()
+        for _ in range(epochs):
+            hogwild.epoch()
+        return len(columns[2]) * epochs / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    freeze_random()  # 冻结随机数 保证结果一致
+
+    type_ = "tp"
+    density = 0.2
+    latent_dim = 8
+    epochs = 5
+    batch_size = 256
+    md_data = MatrixDataset(type_)
+    train_data, test_data = md_data.split_train_test(density)
+    columns = split_triad(train_data)
+
+    workers = [1, 2, 4, 8, 16, 32, 64]
+    workers = [n for n in workers if n <= os.cpu_count()]
+    settings = {
+        "sgd": dict(lr=0.0001, lambda_=0.1, batch_size=batch_size),
+        "nmf": dict(lr=0.001, batch_size=batch_size),
+    }
+    for kernel, kwargs in settings.items():
+        speed = bench_serial(md_data.row_n, md_data.col_n, latent_dim,
+                             columns, kernel, epochs, **kwargs)
+        print(f"kernel:{kernel}, n_jobs:serial, ratings/s:{speed:.0f}")
+        for n_jobs in workers:
+            speed = bench_hogwild(md_data.row_n, md_data.col_n, latent_dim,
+                                  columns, kernel, epochs, n_jobs, **kwargs)
+            print(f"kernel:{kernel}, n_jobs:{n_jobs}, ratings/s:{speed:.0f}")
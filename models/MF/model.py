@@ -1,8 +1,9 @@
-import copy
-
 import numpy as np
 from tqdm import tqdm
 from utils.evaluation import mae, mse, rmse
+from utils.factorization import (ALSSolver, FactorScorer, HogwildSGD,
+                                 fold_in, is_converged, sgd_epoch,
+                                 split_triad)
 
 
 class MFModel(object):
@@ -35,32 +36,55 @@ class MFModel(object):
         self.item_vec = np.random.normal(0, 0.1,
                                          (self.n_item, self.latent_dim))
 
-    def fit(self, triad, test, epochs=100, verbose=True, early_stop=True):
-        if not self.user_vec and not self.item_vec:
+    def fit(self,
+            triad,
+            test,
+            epochs=100,
+            verbose=True,
+            early_stop=True,
+            batch_size=1,
+            solver="sgd",
+            n_jobs=1,
+            seed=None):
+        """训练模型
+
+        Args:
+            triad (): 训练数据三元组: (uid, iid, rating)
+            test (): 测试数据三元组, verbose为True时每10轮输出一次测试集的MAE
+            epochs (): 训练轮数
+            verbose (): 是否输出训练过程
+            early_stop (): 一轮内参数的平均变化量小于1e-4时提前结束训练
+            batch_size (): mini-batch的大小, 1表示逐条更新. 同一batch内的梯度基于batch开始时的参数计算
+            solver (): 求解方法, 可选参数: sgd(随机梯度下降), als(交替最小二乘, 每一轮为一次完整的交替更新, 不使用lr)
+            n_jobs (): 进程数, -1表示使用所有CPU核心. SGD在n_jobs不为1时使用Hogwild式的无锁并行训练
+            seed (): 并行SGD打乱训练数据的随机种子, None表示使用np.random的全局状态
+        """
+        assert solver in ("sgd", "als"), f"unknown solver: {solver}"
+        if self.user_vec is None and self.item_vec is None:
             self._init_vec()
+        uids, iids, rates = split_triad(triad)
+        if solver == "als":
+            self._fit_als(uids, iids, rates, test, epochs, verbose,
+                          early_stop, n_jobs)
+            return
+
+        if n_jobs != 1:
+            self._fit_hogwild(uids, iids, rates, test, epochs, verbose,
+                              early_stop, batch_size, n_jobs, seed)
+            return
+
+        # 累加每一轮参数的变化量, 不需要为判断收敛拷贝整个特征矩阵
+        user_delta = np.zeros_like(self.user_vec)
+        item_delta = np.zeros_like(self.item_vec)
 
         for epoch in tqdm(range(epochs), desc="MF Training Epoch"):
+            user_delta.fill(0)
+            item_delta.fill(0)
+            sgd_epoch(self.user_vec, self.item_vec, uids, iids, rates,
+                      self.lr, self.lambda_, batch_size, user_delta,
+                      item_delta)
 
-            tmp_user_vec = copy.deepcopy(self.user_vec)
-            tmp_item_vec = copy.deepcopy(self.item_vec)
-
-            for row in triad:
-                user_idx, item_idx, y = int(row[0]), int(row[1]), float(row[2])
-                # 计算预测值
-                y_pred = self.user_vec[user_idx] @ self.item_vec[item_idx].T
-                e_ui = y - y_pred
-                # 计算用户梯度
-                user_grad = -1 * e_ui * self.item_vec[
-                    item_idx] + 1 * self.lambda_ * self.user_vec[user_idx]
-                # 计算物品梯度
-                item_grad = -1 * e_ui * self.user_vec[
-                    user_idx] + 1 * self.lambda_ * self.item_vec[item_idx]
-                # 梯度更新
-                self.user_vec[user_idx] -= self.lr * user_grad
-                self.item_vec[item_idx] -= self.lr * item_grad
-
-            if early_stop and np.mean(np.abs(self.user_vec - tmp_user_vec)) < 1e-4 and \
-                np.mean(np.abs(self.item_vec - tmp_item_vec)) < 1e-4:
+            if early_stop and is_converged((user_delta, item_delta)):
                 print('Converged')
                 break
 
@@ -68,14 +92,97 @@ class MFModel(object):
                 y_list, y_pred_list = self.predict(test)
                 print(f"[{epoch}/{epochs}] MAE:{mae(y_list,y_pred_list):.5f}")
 
+    def _fit_hogwild(self, uids, iids, rates, test, epochs, verbose,
+                     early_stop, batch_size, n_jobs, seed):
+        with HogwildSGD(self.user_vec,
+                        self.item_vec,
+                        uids,
+                        iids,
+                        rates,
+                        kernel="sgd",
+                        n_jobs=n_jobs,
+                        seed=seed,
+                        lr=self.lr,
+                        lambda_=self.lambda_,
+                        batch_size=batch_size) as hogwild:
+            for epoch in tqdm(range(epochs), desc="MF Hogwild Epoch"):
+                deltas = hogwild.epoch()
+
+                if early_stop and is_converged(deltas):
+                    print('Converged')
+                    break
+
+                if verbose and (epoch + 1) % 10 == 0:
+                    y_list, y_pred_list = self.predict(test)
+                    print(
+                        f"[{epoch}/{epochs}] MAE:{mae(y_list,y_pred_list):.5f}")
+
+    def _fit_als(self, uids, iids, rates, test, epochs, verbose, early_stop,
+                 n_jobs):
+        with ALSSolver(uids, iids, rates, self.n_user, self.n_item,
+                       self.latent_dim, self.lambda_, n_jobs) as solver:
+            for epoch in tqdm(range(epochs), desc="MF ALS Sweep"):
+                deltas = solver.sweep(self.user_vec, self.item_vec)
+
+                if early_stop and is_converged(deltas):
+                    print('Converged')
+                    break
+
+                if verbose:
+                    y_list, y_pred_list = self.predict(test)
+                    print(
+                        f"[{epoch}/{epochs}] MAE:{mae(y_list,y_pred_list):.5f}")
+
     def predict(self, triad):
         assert isinstance(self.user_vec,
                           np.ndarray), "please fit first e.g. model.fit()"
-        y_pred_list = []
-        y_list = []
-        for row in tqdm(triad):
-            uid, iid, y = int(row[0]), int(row[1]), float(row[2])
-            y_pred = self.user_vec[uid] @ self.item_vec[iid].T
-            y_pred_list.append(y_pred)
-            y_list.append(y)
-        return y_list, y_pred_list
+        return FactorScorer(self.user_vec, self.item_vec).predict(triad)
+
+    def recommend(self,
+                  uids,
+                  k=10,
+                  exclude=None,
+                  candidates=None,
+                  largest=False):
+        """Top-N服务推荐, 参数和返回值见FactorScorer.top_n
+        """
+        assert isinstance(self.user_vec,
+                          np.ndarray), "please fit first e.g. model.fit()"
+        scorer = FactorScorer(self.user_vec, self.item_vec)
+        return scorer.top_n(uids, k, exclude, candidates, largest)
+
+    def fold_in_user(self, iids, rates):
+        """固定项目特征矩阵, 用新用户的观测求解其特征向量并加入模型
+
+        正则项按观测数加权, 与SGD中每条评分都带正则项的目标函数一致
+
+        Args:
+            iids : 新用户调用过的服务id
+            rates : 对应的QoS值
+
+        Returns:
+            int: 新用户的uid
+        """
+        assert isinstance(self.item_vec,
+                          np.ndarray), "please fit first e.g. model.fit()"
+        vec = fold_in(self.item_vec, iids, rates, self.lambda_)
+        self.user_vec = np.vstack([self.user_vec, vec])
+        self.n_user += 1
+        return self.n_user - 1
+
+    def fold_in_item(self, uids, rates):
+        """固定用户特征矩阵, 用新服务的观测求解其特征向量并加入模型
+
+        Args:
+            uids : 调用过新服务的用户id
+            rates : 对应的QoS值
+
+        Returns:
+            int: 新服务的iid
+        """
+        assert isinstance(self.user_vec,
+                          np.ndarray), "please fit first e.g. model.fit()"
+        vec = fold_in(self.user_vec, uids, rates, self.lambda_)
+        self.item_vec = np.vstack([self.item_vec, vec])
+        self.n_item += 1
+        return self.n_item - 1
@@ -62,5 +62,8 @@ class MLPModel(ModelBase):
     def parameters(self):
         return self.model.parameters()
 
+    def fold_in_embeddings(self, side):
+        return [getattr(self.model, f"embedding_{side}")]
+
     def __repr__(self) -> str:
         return str(self.model)
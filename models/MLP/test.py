@@ -1,9 +1,8 @@
 import torch
-from data import MatrixDataset, ToTorchDataset
+from data import MatrixDataset, TensorBatchLoader
 from torch import nn, optim
 from torch.nn.modules import loss
 from torch.optim import Adam
-from torch.utils.data import DataLoader
 from utils.evaluation import mae, mse, rmse
 from root import absolute
 from .model import MLPModel
@@ -29,10 +28,8 @@ for density in [0.05, 0.10, 0.15, 0.20]:
     rt_data = MatrixDataset(type_)
     train_data, test_data = rt_data.split_train_test(density)
 
-    train_dataset = ToTorchDataset(train_data)
-    test_dataset = ToTorchDataset(test_data)
-    train_dataloader = DataLoader(train_dataset, batch_size=64)
-    test_dataloader = DataLoader(test_dataset, batch_size=64)
+    train_dataloader = TensorBatchLoader(train_data, batch_size=64)
+    test_dataloader = TensorBatchLoader(test_data, batch_size=64)
 
     lr = 0.01
     epochs = 100
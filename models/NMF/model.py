@@ -1,11 +1,11 @@
-import copy
-
 import numpy as np
 # Non-negative Matrix Factorization
 from sklearn.decomposition import NMF
 from tqdm import tqdm
 from utils.evaluation import mae, mse, rmse
-from utils.model_util import triad_to_matrix
+from utils.factorization import (FactorScorer, HogwildSGD, is_converged,
+                                 nmf_mu_step, nmf_sgd_epoch, split_triad)
+from utils.model_util import SparseQoSMatrix
 
 
 class NMFModel(object):
@@ -37,14 +37,21 @@ class NMFModel(object):
 
         self.user_matrix = np.random.random((self.n_user, self.latent_dim))
         self.item_matrix = np.random.random((self.n_item, self.latent_dim))
-        self.matrix = triad_to_matrix(triad, self._nan_symbol)
-        self.matrix[self.matrix == self._nan_symbol] = 0
+        uids, iids, rates = split_triad(triad)
+        # 形状使用模型的用户数和项目数, 训练集中可能没有最后几个用户或服务
+        self.matrix = SparseQoSMatrix(uids, iids, rates,
+                                      (self.n_user, self.n_item),
+                                      self._nan_symbol)
 
     def _normalize(self):
-        m, n = self.matrix.shape
-        _matrix = copy.deepcopy(self.matrix)
-        for i in range(n):
-            self.matrix[:, i] = _matrix[:, i] / np.sum(_matrix[:, i])
+        """每一列的观测值除以该列的和
+        """
+        coo = self.matrix.csc.tocoo()
+        col_sum = np.asarray(self.matrix.csc.sum(axis=0)).ravel()
+        self.matrix = SparseQoSMatrix(coo.row, coo.col,
+                                      coo.data / col_sum[coo.col],
+                                      (self.n_user, self.n_item),
+                                      self._nan_symbol)
 
     def fit(self,
             triad,
@@ -52,63 +59,76 @@ class NMFModel(object):
             epochs=100,
             verbose=False,
             early_stop=True,
-            normalize=False):
-        if (not self.user_matrix and not self.item_matrix) or self.matrix:
+            normalize=False,
+            batch_size=1,
+            n_jobs=1,
+            seed=None,
+            solver="sgd"):
+        """训练模型
+
+        Args:
+            triad (): 训练数据三元组: (uid, iid, rating)
+            test (): 测试数据三元组, verbose为True时每20轮输出一次测试集的MAE
+            epochs (): 训练轮数
+            verbose (): 是否输出训练过程
+            early_stop (): 一轮内参数的平均变化量小于1e-4时提前结束训练
+            normalize (): 是否按列归一化QoS矩阵
+            batch_size (): mini-batch的大小, 1表示逐条更新
+            n_jobs (): 进程数, -1表示使用所有CPU核心, 不为1时使用Hogwild式的无锁并行训练
+            seed (): 并行训练打乱训练数据的随机种子, None表示使用np.random的全局状态
+            solver (): 求解方法, 可选参数: sgd(投影随机梯度下降), mu(带掩码的乘法更新, 每一轮更新整个W和H, 使用lambda_正则化)
+        """
+        assert solver in ("sgd", "mu"), f"unknown solver: {solver}"
+        if self.user_matrix is None or self.item_matrix is None or \
+                self.matrix is not None:
             self._init_matrix(triad)
 
         # 测试了貌似没效果
         if normalize:
             self._normalize()
-        """
-        # FIXME 手动实现，有时会不收敛，没找到问题
-        eps = 0.00001
-        for epoch in tqdm(range(epochs), desc="NMF Training Epoch"):
-            W = copy.deepcopy(self.user_matrix)
-            H = copy.deepcopy(self.item_matrix)
-            self.user_matrix = W * (self.matrix @ H.T) / (W @ H @ H.T + eps)
-            W = copy.deepcopy(self.user_matrix)
-            H = copy.deepcopy(self.item_matrix)
-            self.item_matrix = H * (W.T @ self.matrix) / (W.T @ W @ H + eps)
-
-        
-        # sklearn实现
-        # nmf_model = NMF(n_components=self.latent_dim, init='nndsvda', solver='mu')
-        # self.user_matrix = nmf_model.fit_transform(self.matrix)
-        # self.item_matrix = nmf_model.components_
-
-        """
-
-        for epoch in tqdm(range(epochs), desc="NMF Training Epoch"):
-
-            tmp_user_matrix = copy.deepcopy(self.user_matrix)
-            tmp_item_matrix = copy.deepcopy(self.item_matrix)
+        if solver == "mu":
+            self._fit_mu(test, epochs, verbose, early_stop)
+            return
 
-            for row in triad:
-                user_idx, item_idx, y = int(row[0]), int(row[1]), float(row[2])
-                y_pred = self.user_matrix[user_idx] @ self.item_matrix[
-                    item_idx].T
-                e_ui = y - y_pred
+        uids, iids, rates = split_triad(triad)
+        if n_jobs != 1:
+            self._fit_hogwild(uids, iids, rates, test, epochs, verbose,
+                              early_stop, batch_size, n_jobs, seed)
+            return
 
-                user_grad = -1 * e_ui * self.item_matrix[item_idx]
-                self.user_matrix[user_idx] -= self.lr * user_grad
-                self.user_matrix[user_idx][self.user_matrix[user_idx] < 0] = 0
-                item_grad = -1 * e_ui * self.user_matrix[user_idx]
-                self.item_matrix[item_idx] -= self.lr * item_grad
-                self.item_matrix[item_idx][self.item_matrix[item_idx] < 0] = 0
+        # 累加每一轮参数的变化量, 不需要为判断收敛拷贝整个特征矩阵
+        user_delta = np.zeros_like(self.user_matrix)
+        item_delta = np.zeros_like(self.item_matrix)
 
-            # up_W = self.matrix @ self.item_matrix.T
-            # down_W = self.user_matrix @ self.item_matrix @ self.item_matrix.T
-
-            # self.user_matrix = self.user_matrix * up_W / down_W
+        for epoch in tqdm(range(epochs), desc="NMF Training Epoch"):
+            user_delta.fill(0)
+            item_delta.fill(0)
+            nmf_sgd_epoch(self.user_matrix, self.item_matrix, uids, iids,
+                          rates, self.lr, batch_size, user_delta, item_delta)
 
-            # up_H = self.user_matrix.T @ self.matrix
-            # down_H = self.user_matrix.T @ self.user_matrix @ self.item_matrix
+            if early_stop and is_converged((user_delta, item_delta)):
+                print('Converged')
+                break
 
-            # self.item_matrix = self.item_matrix * up_H / down_H
+            if verbose and (epoch + 1) % 20 == 0:
+                y_list, y_pred_list = self.predict(test)
+                print(f"[{epoch}/{epochs}] MAE:{mae(y_list,y_pred_list):.5f}")
 
+    def _fit_mu(self, test, epochs, verbose, early_stop):
+        """带掩码的乘法更新
 
-            if early_stop and np.mean(np.abs(self.user_matrix - tmp_user_matrix)) < 1e-4 and \
-                np.mean(np.abs(self.item_matrix - tmp_item_matrix)) < 1e-4:
+        只在观测位置计算重构误差(原来的手动实现把缺失项-1也当作观测值, 因此不收敛)
+        """
+        m = self.matrix.csr
+        for epoch in tqdm(range(epochs), desc="NMF MU Epoch"):
+            user_matrix, item_matrix = nmf_mu_step(m, self.user_matrix,
+                                                   self.item_matrix,
+                                                   self.lambda_)
+            deltas = (user_matrix - self.user_matrix,
+                      item_matrix - self.item_matrix)
+            self.user_matrix, self.item_matrix = user_matrix, item_matrix
+
+            if early_stop and is_converged(deltas):
                 print('Converged')
                 break
 
@@ -116,13 +136,42 @@ class NMFModel(object):
                 y_list, y_pred_list = self.predict(test)
                 print(f"[{epoch}/{epochs}] MAE:{mae(y_list,y_pred_list):.5f}")
 
+    def _fit_hogwild(self, uids, iids, rates, test, epochs, verbose,
+                     early_stop, batch_size, n_jobs, seed):
+        with HogwildSGD(self.user_matrix,
+                        self.item_matrix,
+                        uids,
+                        iids,
+                        rates,
+                        kernel="nmf",
+                        n_jobs=n_jobs,
+                        seed=seed,
+                        lr=self.lr,
+                        batch_size=batch_size) as hogwild:
+            for epoch in tqdm(range(epochs), desc="NMF Hogwild Epoch"):
+                deltas = hogwild.epoch()
+
+                if early_stop and is_converged(deltas):
+                    print('Converged')
+                    break
+
+                if verbose and (epoch + 1) % 20 == 0:
+                    y_list, y_pred_list = self.predict(test)
+                    print(
+                        f"[{epoch}/{epochs}] MAE:{mae(y_list,y_pred_list):.5f}")
+
     def predict(self, triad):
         assert self.user_matrix is not None, "Please fit first e.g. model.fit()"
-        y_pred_list = []
-        y_list = []
-        for row in tqdm(triad, desc='NMF Perdicting'):
-            uid, iid, y = int(row[0]), int(row[1]), float(row[2])
-            y_pred = self.user_matrix[uid] @ self.item_matrix[iid].T
-            y_pred_list.append(y_pred)
-            y_list.append(y)
-        return y_list, y_pred_list
+        return FactorScorer(self.user_matrix, self.item_matrix).predict(triad)
+
+    def recommend(self,
+                  uids,
+                  k=10,
+                  exclude=None,
+                  candidates=None,
+                  largest=False):
+        """Top-N服务推荐, 参数和返回值见FactorScorer.top_n
+        """
+        assert self.user_matrix is not None, "please fit first e.g. model.fit()"
+        scorer = FactorScorer(self.user_matrix, self.item_matrix)
+        return scorer.top_n(uids, k, exclude, candidates, largest)
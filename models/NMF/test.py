@@ -1,3 +1,4 @@
+import numpy as np
 from data import MatrixDataset
 # Non-negative Matrix Factorization
 from sklearn.decomposition import NMF
@@ -53,3 +54,26 @@ for density in [0.05, 0.1, 0.15, 0.2]:
     logger.info(
         f"Density:{density:.02f}, type:{type_}, latent_dim:{latent_dim:{3}}, epochs:{epochs:{4}}, mae:{mae_:.04f}, mse:{mse_:.04f}, rmse:{rmse_:.04f}"
     )
+
+
+def check_missing_trailing_ids(seed=0):
+    """训练集中没有最后几个用户和服务时, 两种solver都能训练, 并能预测这些用户和服务
+
+    在实验之后用单独的种子运行, 不影响上面实验的随机数
+    """
+    freeze_random(seed)
+    n_user, n_item = 10, 15
+    triad = np.stack([
+        np.random.randint(0, n_user - 2, 60),
+        np.random.randint(0, n_item - 3, 60),
+        np.random.random(60)
+    ], 1)
+    test = np.array([[n_user - 1, n_item - 1, 0.5]])
+    for solver in ["sgd", "mu"]:
+        nmf = NMFModel(n_user, n_item, 4)
+        nmf.fit(triad, test, 5, early_stop=False, solver=solver)
+        assert nmf.matrix.shape == (n_user, n_item)
+        assert nmf.predict(test)[1].shape == (1, )
+
+
+check_missing_trailing_ids()
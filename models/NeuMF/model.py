@@ -72,5 +72,8 @@ class NeuMFModel(ModelBase):
     def parameters(self):
         return self.model.parameters()
 
+    def fold_in_embeddings(self, side):
+        return [getattr(self.model, f"GMF_embedding_{side}"), getattr(self.model, f"MLP_embedding_{side}")]
+
     def __repr__(self) -> str:
         return str(self.model)
@@ -0,0 +1,327 @@
+import numpy as np
+from scipy.stats import wishart
+from tqdm import tqdm
+from utils.evaluation import mae
+from utils.factorization import (ALSSolver, FactorScorer, HogwildSGD,
+                                 als_tasks, fold_in, is_converged,
+                                 per_row_lambda, sgd_epoch, split_triad)
+
+
+class PMFModel(object):
+    """Probabilistic Matrix Factorization
+
+    R_ij ~ N(U_i V_j^T, sigma^2), U_i ~ N(0, sigma_U^2 I), V_j ~ N(0, sigma_V^2 I),
+    最大化后验概率等价于带正则项的平方误差: lambda_u = sigma^2 / sigma_U^2, lambda_v = sigma^2 / sigma_V^2
+    SGD把正则项平摊到每条评分上(per_row_lambda), 与ALS和fold_in优化同一个目标函数
+    """
+    def __init__(self,
+                 n_user,
+                 n_item,
+                 latent_dim,
+                 lr=0.001,
+                 lambda_u=0.1,
+                 lambda_v=0.1) -> None:
+        super().__init__()
+        self.lr = lr
+        self.lambda_u = lambda_u  # 用户特征的正则化系数
+        self.lambda_v = lambda_v  # 项目特征的正则化系数
+        self.latent_dim = latent_dim
+        self.n_user = n_user
+        self.n_item = n_item
+        self.user_vec = None
+        self.item_vec = None
+
+    def _init_vec(self):
+        """初始化用户和物品的特征矩阵
+        """
+        self.user_vec = np.random.normal(0, 0.1,
+                                         (self.n_user, self.latent_dim))
+        self.item_vec = np.random.normal(0, 0.1,
+                                         (self.n_item, self.latent_dim))
+
+    def fit(self,
+            triad,
+            test,
+            epochs=100,
+            verbose=True,
+            early_stop=True,
+            batch_size=256,
+            solver="sgd",
+            n_jobs=1,
+            seed=None):
+        """训练模型
+
+        Args:
+            triad (): 训练数据三元组: (uid, iid, rating)
+            test (): 测试数据三元组, verbose为True时每10轮输出一次测试集的MAE
+            epochs (): 训练轮数(ALS为交替更新的轮数)
+            verbose (): 是否输出训练过程
+            early_stop (): 一轮内参数的平均变化量小于1e-4时提前结束训练
+            batch_size (): mini-batch的大小, 1表示逐条更新
+            solver (): 求解方法, 可选参数: sgd(mini-batch梯度下降), als(MAP估计的交替最小二乘, 不使用lr)
+            n_jobs (): 进程数, -1表示使用所有CPU核心. SGD在n_jobs不为1时使用Hogwild式的无锁并行训练
+            seed (): 并行SGD打乱训练数据的随机种子, None表示使用np.random的全局状态
+        """
+        assert solver in ("sgd", "als"), f"unknown solver: {solver}"
+        if self.user_vec is None and self.item_vec is None:
+            self._init_vec()
+        uids, iids, rates = split_triad(triad)
+        # SGD中每个用户/项目一轮的惩罚为lambda, 而不是lambda * 评分数
+        lambda_u = per_row_lambda(self.lambda_u, uids, self.n_user)
+        lambda_v = per_row_lambda(self.lambda_v, iids, self.n_item)
+
+        if solver == "als":
+            trainer = ALSSolver(uids,
+                                iids,
+                                rates,
+                                self.n_user,
+                                self.n_item,
+                                self.latent_dim,
+                                self.lambda_u,
+                                n_jobs,
+                                lambda_item=self.lambda_v,
+                                weighted=False)
+            step = lambda: trainer.sweep(self.user_vec, self.item_vec)
+        elif n_jobs != 1:
+            trainer = HogwildSGD(self.user_vec,
+                                 self.item_vec,
+                                 uids,
+                                 iids,
+                                 rates,
+                                 kernel="sgd",
+                                 n_jobs=n_jobs,
+                                 seed=seed,
+                                 lr=self.lr,
+                                 lambda_=lambda_u,
+                                 lambda_item=lambda_v,
+                                 batch_size=batch_size)
+            step = trainer.epoch
+        else:
+            trainer = None
+            # 累加每一轮参数的变化量, 用于判断收敛
+            user_delta = np.zeros_like(self.user_vec)
+            item_delta = np.zeros_like(self.item_vec)
+
+            def step():
+                user_delta.fill(0)
+                item_delta.fill(0)
+                sgd_epoch(self.user_vec,
+                          self.item_vec,
+                          uids,
+                          iids,
+                          rates,
+                          self.lr,
+                          lambda_u,
+                          batch_size,
+                          user_delta,
+                          item_delta,
+                          lambda_item=lambda_v)
+                return user_delta, item_delta
+
+        try:
+            for epoch in tqdm(range(epochs), desc="PMF Training Epoch"):
+                deltas = step()
+
+                if early_stop and is_converged(deltas):
+                    print('Converged')
+                    break
+
+                if verbose and (epoch + 1) % 10 == 0:
+                    y_list, y_pred_list = self.predict(test)
+                    print(
+                        f"[{epoch}/{epochs}] MAE:{mae(y_list,y_pred_list):.5f}"
+                    )
+        finally:
+            if trainer is not None:
+                trainer.close()
+
+    def predict(self, triad):
+        assert isinstance(self.user_vec,
+                          np.ndarray), "please fit first e.g. model.fit()"
+        return FactorScorer(self.user_vec, self.item_vec).predict(triad)
+
+    def recommend(self,
+                  uids,
+                  k=10,
+                  exclude=None,
+                  candidates=None,
+                  largest=False):
+        """Top-N服务推荐, 参数和返回值见FactorScorer.top_n
+        """
+        assert isinstance(self.user_vec,
+                          np.ndarray), "please fit first e.g. model.fit()"
+        scorer = FactorScorer(self.user_vec, self.item_vec)
+        return scorer.top_n(uids, k, exclude, candidates, largest)
+
+    def fold_in_user(self, iids, rates):
+        """固定项目特征矩阵, 用新用户的观测求解其特征向量并加入模型(MAP估计)
+
+        Args:
+            iids : 新用户调用过的服务id
+            rates : 对应的QoS值
+
+        Returns:
+            int: 新用户的uid
+        """
+        assert isinstance(self.item_vec,
+                          np.ndarray), "please fit first e.g. model.fit()"
+        vec = fold_in(self.item_vec, iids, rates, self.lambda_u,
+                      weighted=False)
+        self.user_vec = np.vstack([self.user_vec, vec])
+        self.n_user += 1
+        return self.n_user - 1
+
+    def fold_in_item(self, uids, rates):
+        """固定用户特征矩阵, 用新服务的观测求解其特征向量并加入模型
+
+        Args:
+            uids : 调用过新服务的用户id
+            rates : 对应的QoS值
+
+        Returns:
+            int: 新服务的iid
+        """
+        assert isinstance(self.user_vec,
+                          np.ndarray), "please fit first e.g. model.fit()"
+        vec = fold_in(self.user_vec, uids, rates, self.lambda_v,
+                      weighted=False)
+        self.item_vec = np.vstack([self.item_vec, vec])
+        self.n_item += 1
+        return self.n_item - 1
+
+
+class BPMFModel(object):
+    """Bayesian Probabilistic Matrix Factorization
+
+    用户/项目特征的均值和精度矩阵使用Gaussian-Wishart先验, 用Gibbs采样近似后验分布,
+    预测值为burn_in之后各次采样预测值的平均. 观测数相同的用户/项目堆叠成一块,
+    每一块的条件分布用一次批量的Cholesky分解采样.
+
+    Args:
+        n_user, n_item : 用户数和项目数
+        latent_dim : 隐特征维度
+        alpha : 观测值的精度(1 / sigma^2)
+        beta0 : 特征均值先验的精度缩放系数
+    """
+    def __init__(self,
+                 n_user,
+                 n_item,
+                 latent_dim,
+                 alpha=2.0,
+                 beta0=2.0) -> None:
+        super().__init__()
+        self.n_user = n_user
+        self.n_item = n_item
+        self.latent_dim = latent_dim
+        self.alpha = alpha
+        self.beta0 = beta0
+        self.nu0 = latent_dim  # Wishart先验的自由度
+        self.mu0 = np.zeros(latent_dim)  # 特征均值的先验均值
+        self.w0_inv = np.eye(latent_dim)  # Wishart先验尺度矩阵的逆
+        self.user_vec = None
+        self.item_vec = None
+        self.mean_rate = 0  # 训练数据的评分均值, 采样时评分减去该值
+        self.samples = []  # burn_in之后的(用户特征, 项目特征)采样
+
+    def _init_vec(self):
+        self.user_vec = np.random.normal(0, 0.1,
+                                         (self.n_user, self.latent_dim))
+        self.item_vec = np.random.normal(0, 0.1,
+                                         (self.n_item, self.latent_dim))
+
+    def fit(self, triad, test, epochs=50, burn_in=10, verbose=True):
+        """Gibbs采样
+
+        Args:
+            triad (): 训练数据三元组: (uid, iid, rating)
+            test (): 测试数据三元组, verbose为True时每10轮输出一次测试集的MAE
+            epochs (): 采样轮数
+            burn_in (): 前burn_in轮的采样不参与预测
+            verbose (): 是否输出训练过程
+        """
+        if self.user_vec is None and self.item_vec is None:
+            self._init_vec()
+        uids, iids, rates = split_triad(triad)
+        self.mean_rate = rates.mean()
+        rates = rates - self.mean_rate
+        tasks = {
+            "user": als_tasks(uids, iids, rates, self.n_user,
+                              self.latent_dim),
+            "item": als_tasks(iids, uids, rates, self.n_item,
+                              self.latent_dim)
+        }
+        self.samples = []
+
+        for epoch in tqdm(range(epochs), desc="BPMF Gibbs Sampling"):
+            mu, lam = self._sample_hyper(self.user_vec)
+            self.user_vec = self._sample_vec(self.item_vec, tasks["user"],
+                                             self.n_user, mu, lam)
+            mu, lam = self._sample_hyper(self.item_vec)
+            self.item_vec = self._sample_vec(self.user_vec, tasks["item"],
+                                             self.n_item, mu, lam)
+            if epoch >= burn_in:
+                self.samples.append((self.user_vec, self.item_vec))
+
+            if verbose and (epoch + 1) % 10 == 0:
+                y_list, y_pred_list = self.predict(test)
+                print(f"[{epoch}/{epochs}] MAE:{mae(y_list,y_pred_list):.5f}")
+
+    def _sample_hyper(self, vec):
+        """从Gaussian-Wishart后验中采样特征的均值和精度矩阵
+        """
+        n = len(vec)
+        mean = vec.mean(axis=0)
+        centered = vec - mean
+        s = centered.T @ centered / n
+        beta = self.beta0 + n
+        mu = (self.beta0 * self.mu0 + n * mean) / beta
+        diff = self.mu0 - mean
+        w_inv = self.w0_inv + n * s + self.beta0 * n / beta * np.outer(
+            diff, diff)
+        w = np.linalg.inv(w_inv)
+        lam = np.atleast_2d(wishart.rvs(df=self.nu0 + n, scale=(w + w.T) / 2))
+        mu = np.random.multivariate_normal(mu, np.linalg.inv(beta * lam))
+        return mu, lam
+
+    def _sample_vec(self, fixed, tasks, n_rows, mu, lam):
+        """按块从条件高斯分布中采样一侧的特征矩阵
+
+        精度矩阵: lam + alpha * sum(V_j V_j^T), 均值: 精度矩阵^-1 (alpha * sum(r_ij V_j) + lam mu)
+        """
+        vec = np.empty((n_rows, self.latent_dim))
+        prior_b = lam @ mu
+        covered = np.zeros(n_rows, dtype=bool)
+        for rows, cols, vals in tasks:
+            f = fixed[cols]  # (g, c, d)
+            a = lam + self.alpha * np.einsum("gcd,gce->gde", f, f)
+            b = self.alpha * np.einsum("gcd,gc->gd", f, vals) + prior_b
+            vec[rows] = _sample_gaussian(a, b)
+            covered[rows] = True
+        # 没有观测的行从先验中采样
+        rest = np.flatnonzero(~covered)
+        if len(rest):
+            a = np.broadcast_to(lam, (len(rest), *lam.shape))
+            b = np.broadcast_to(prior_b, (len(rest), len(prior_b)))
+            vec[rest] = _sample_gaussian(a, b)
+        return vec
+
+    def predict(self, triad):
+        assert self.user_vec is not None, "please fit first e.g. model.fit()"
+        uids, iids, rates = split_triad(triad)
+        samples = self.samples or [(self.user_vec, self.item_vec)]
+        y_pred = np.zeros(len(rates))
+        for user_vec, item_vec in samples:
+            y_pred += FactorScorer(user_vec, item_vec).score(uids, iids)
+        return rates, y_pred / len(samples) + self.mean_rate
+
+
+def _sample_gaussian(a, b):
+    """批量从N(a^-1 b, a^-1)中采样, a为(g, d, d)的精度矩阵
+    """
+    chol = np.linalg.cholesky(a)
+    mean = np.linalg.solve(a, b[..., None])[..., 0]
+    z = np.random.standard_normal(b.shape)
+    # a = L L^T, L^-T z 的协方差为 a^-1
+    return mean + np.linalg.solve(np.swapaxes(chol, -1, -2), z[...,
+                                                                None])[...,
+                                                                       0]
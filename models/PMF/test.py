@@ -0,0 +1,49 @@
+from data import MatrixDataset
+from utils.evaluation import mae, mse, rmse
+from utils.model_util import freeze_random
+
+from .model import BPMFModel, PMFModel
+"""
+    PMF: mini-batch SGD 或 MAP-ALS 训练, lambda_u / lambda_v 分别为用户和项目特征的正则化系数
+    BPMF: Gibbs采样, 预测值为burn_in之后各次采样的平均
+    与MF使用相同的density / rt / tp 设置
+"""
+
+freeze_random()  # 冻结随机数 保证结果一致
+
+for density in [0.05, 0.1, 0.15, 0.2]:
+
+    type_ = "tp"
+    latent_dim = 8
+    lr = 0.0001
+    lambda_u = 0.1
+    lambda_v = 0.1
+    epochs = 200
+    batch_size = 256
+    md_data = MatrixDataset(type_)
+    train_data, test_data = md_data.split_train_test(density)
+
+    pmf = PMFModel(md_data.row_n, md_data.col_n, latent_dim, lr, lambda_u,
+                   lambda_v)
+    pmf.fit(train_data, test_data, epochs, batch_size=batch_size)
+    y, y_pred = pmf.predict(test_data)
+
+    mae_ = mae(y, y_pred)
+    mse_ = mse(y, y_pred)
+    rmse_ = rmse(y, y_pred)
+
+    print(
+        f"PMF Density:{density},type:{type_},mae:{mae_},mse:{mse_},rmse:{rmse_}"
+    )
+
+    bpmf = BPMFModel(md_data.row_n, md_data.col_n, latent_dim)
+    bpmf.fit(train_data, test_data, epochs=50, burn_in=10)
+    y, y_pred = bpmf.predict(test_data)
+
+    mae_ = mae(y, y_pred)
+    mse_ = mse(y, y_pred)
+    rmse_ = rmse(y, y_pred)
+
+    print(
+        f"BPMF Density:{density},type:{type_},mae:{mae_},mse:{mse_},rmse:{rmse_}"
+    )
@@ -1,46 +1,11 @@
-import copy
-
 import numpy as np
-# 相似度计算库
-from scipy.stats import pearsonr
 from tqdm import tqdm
 from utils.model_util import (nonzero_item_mean, nonzero_user_mean,
                               triad_to_matrix)
-
-
-def cal_similarity_matrix(x, y):
-    """计算两个向量的增强皮尔逊相关系数
-    """
-    nonzero_x = np.nonzero(x)[0]
-    nonzero_y = np.nonzero(y)[0]
-    intersect = np.intersect1d(nonzero_x, nonzero_y)  # 交集
-    # 如果向量交集为空，则相似度为0
-    # 如果一个向量中所有值都相等，则无法计算皮尔逊相关距离(分母为0)
-    if len(intersect) == 0 or len(set(x[intersect])) == 1 or len(
-            set(y[intersect])) == 1:
-        sim = 0
-    else:
-        try:
-            sim = pearsonr(x[intersect], y[intersect])[0]
-            sim = (2 * len(intersect) /
-                   (len(nonzero_x) + len(nonzero_y))) * sim  # 增强PCC
-        except Exception as e:
-            sim = 0
-    return sim
-
-
-def cal_topk(similarity_matrix, id, topk):
-    assert isinstance(topk, int)
-    ordered_id = (
-        -similarity_matrix[id]).argsort()  # 按相似度从大到小排序后, 相似用户/项目对应的索引
-    ordered_id = [
-        sim_id for sim_id in ordered_id if similarity_matrix[sim_id][id] > 0
-    ]  # 只考虑相似度大于0的相似用户/服务
-    if topk == -1:
-        return ordered_id
-    else:
-        assert topk > 0
-        return ordered_id[:topk]
+from utils.similarity_cache import SimilarityCache
+from utils.similarity import (DEFAULT_N_NEIGHBORS, DEFAULT_PREDICT_BATCH_SIZE,
+                              NeighborIndex, pcc_similarity,
+                              weighted_deviation)
 
 
 class UIPCCModel(object):
@@ -51,48 +16,56 @@ class UIPCCModel(object):
         self.i_mean = None  # 每个项目的QoS均值
         self.similarity_user_matrix = None  # 用户相似度矩阵
         self.similarity_item_matrix = None  # 项目相似度矩阵
+        self.user_neighbors = None  # 每个用户的前k个相似用户(只包含相似度大于0的用户)
+        self.item_neighbors = None  # 每个项目的前k个相似项目(只包含相似度大于0的项目)
         self._nan_symbol = -1  # 缺失项标记（数据集中使用-1表示缺失项）
 
-    def get_similarity_matrix(self):
+    def get_similarity_matrix(self,
+                              block_size=None,
+                              memory_budget=None,
+                              out_path=None,
+                              n_jobs=1):
         """获取用户相似度矩阵和项目相似度矩阵
-        """
-        matrix = copy.deepcopy(self.matrix)
-        matrix[matrix == self._nan_symbol] = 0  # 将缺失项用0代替，以便之后计算
-        m, n = matrix.shape
-        similarity_user_matrix = np.zeros((m, m))
-        similarity_item_matrix = np.zeros((n, n))
 
-        # 计算用户相似度矩阵
+        使用向量化的增强PCC(按共同观测数加权的皮尔逊相关系数)
 
-        row_idx, col_idx = np.nonzero(matrix)
-        for i in tqdm(range(m), desc="生成用户相似度矩阵"):
-            for j in range(i + 1, m):
-                nonzero_i = col_idx[row_idx == i]
-                nonzero_j = col_idx[row_idx == j]
-                row_i = matrix[i]
-                row_j = matrix[j]
-                similarity_user_matrix[i][j] = similarity_user_matrix[j][
-                    i] = cal_similarity_matrix(row_i, row_j)
+        Args:
+            block_size : 分块计算时每块的行数, None表示根据memory_budget计算
+            memory_budget : 分块计算的内存预算(字节)
+            out_path : 项目相似度矩阵保存为.npy内存映射文件的路径, None表示保存在内存中
+            n_jobs : 进程数, -1表示使用所有CPU核心, 结果与单进程一致
+        """
+        # 计算用户相似度矩阵
+        similarity_user_matrix = self._similarity_matrix(
+            "user", block_size, memory_budget, None, n_jobs)
 
         # 计算项目相似度矩阵
-        for i in tqdm(range(n), desc="生成项目相似度矩阵"):
-            for j in range(i + 1, n):
-                col_i = matrix[:, i]
-                col_j = matrix[:, j]
-                similarity_item_matrix[i][j] = similarity_item_matrix[j][
-                    i] = cal_similarity_matrix(col_i, col_j)
+        similarity_item_matrix = self._similarity_matrix(
+            "item", block_size, memory_budget, out_path, n_jobs)
 
         return similarity_user_matrix, similarity_item_matrix
 
+    def _similarity_matrix(self, kind, block_size, memory_budget, out,
+                           n_jobs):
+        """计算用户(kind="user")或项目(kind="item")的增强PCC相似度矩阵
+        """
+        m = self.matrix.csr if kind == "user" else self.matrix.csc.T
+        return pcc_similarity(m,
+                              enhanced=True,
+                              block_size=block_size,
+                              memory_budget=memory_budget,
+                              out=out,
+                              n_jobs=n_jobs)
+
     def get_similarity_users(self, uid, topk=-1):
-        """获取前topk个相似用户
+        """获取前topk个相似用户及其相似度, 只考虑相似度大于0的相似用户
         """
-        return cal_topk(self.similarity_user_matrix, uid, topk)
+        return self.user_neighbors.neighbors(uid, topk)
 
     def get_similarity_items(self, iid, topk=-1):
-        """获取前topk个相似项目
+        """获取前topk个相似项目及其相似度, 只考虑相似度大于0的相似项目
         """
-        return cal_topk(self.similarity_item_matrix, iid, topk)
+        return self.item_neighbors.neighbors(iid, topk)
 
     def get_user_similarity(self, uid_a, uid_b):
         """传入两个用户的id，获取这两个用户的相似度
@@ -112,111 +85,176 @@ class UIPCCModel(object):
             return 0
         return self.similarity_item_matrix[iid_a][iid_b]
 
-    def _upcc(self, uid, iid, similarity_users, u_mean):
-        up = 0
-        down = 0
-        for sim_uid in similarity_users:  # 对于目标用户的每一个相似用户
-            sim_user_rate = self.matrix[sim_uid][iid]  # 相似用户对目标项目的评分
-            similarity = self.get_user_similarity(sim_uid,
-                                                  uid)  # 相似用户与目标用户的相似度
-            if sim_user_rate == self._nan_symbol:
-                continue
-            up += similarity * (sim_user_rate - self.u_mean[sim_uid])
-            down += similarity
-        if down != 0:
-            y_pred = u_mean + up / down
-        else:
-            y_pred = u_mean
-        return y_pred
-
-    def _ipcc(self, uid, iid, similarity_items, i_mean):
-        up = 0
-        down = 0
-        for sim_iid in similarity_items:  # 对于目标项目的每一个相似项目
-            sim_item_rate = self.matrix[uid][sim_iid]  # 目标用户对相似项目的评分
-            similarity = self.get_item_similarity(sim_iid,
-                                                  iid)  # 相似项目与目标项目的相似度
-            if sim_item_rate == self._nan_symbol:
-                continue
-            up += similarity * (sim_item_rate - self.i_mean[sim_iid])
-            down += similarity
-        if down != 0:
-            y_pred = i_mean + up / down
-        else:
-            y_pred = i_mean
-        return y_pred
+    def _upcc(self, uid, iid, similarity_users, similarities, u_mean):
+        """批量计算UPCC的预测值, 相似用户对目标项目没有评分时不进行计算
+        """
+        sim_user_rates = self.matrix.get(similarity_users,
+                                         iid[:, None])  # 相似用户对目标项目的评分
+        valid = (similarity_users >= 0) & (sim_user_rates != self._nan_symbol)
+        up, down = weighted_deviation(similarity_users, similarities,
+                                      sim_user_rates, self.u_mean, valid)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(down != 0, u_mean + up / down, u_mean)
+
+    def _ipcc(self, uid, iid, similarity_items, similarities, i_mean):
+        """批量计算IPCC的预测值, 目标用户对相似项目没有评分时不进行计算
+        """
+        sim_item_rates = self.matrix.get(uid[:, None],
+                                         similarity_items)  # 目标用户对相似项目的评分
+        valid = (similarity_items >= 0) & (sim_item_rates != self._nan_symbol)
+        up, down = weighted_deviation(similarity_items, similarities,
+                                      sim_item_rates, self.i_mean, valid)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(down != 0, i_mean + up / down, i_mean)
 
-    def fit(self, triad):
+    def fit(self,
+            triad,
+            block_size=None,
+            memory_budget=None,
+            out_path=None,
+            n_neighbors=DEFAULT_N_NEIGHBORS,
+            n_jobs=1,
+            use_cache=True):
         """训练模型
 
         Args:
             triad (): 数据三元组: (uid, iid, rating)
+            block_size (): 计算相似度矩阵时每块的行数, None表示根据memory_budget计算
+            memory_budget (): 计算相似度矩阵的内存预算(字节), 默认512MB
+            out_path (): 项目相似度矩阵保存为.npy内存映射文件的路径, None表示保存在内存中
+            n_neighbors (): 近邻索引中为每个用户/项目保存的近邻数量, 预测时topk不超过该值则不需要重新排序
+            n_jobs (): 计算相似度矩阵使用的进程数, -1表示使用所有CPU核心, 结果与单进程一致
+            use_cache (): 是否使用相似度缓存, 相同的训练数据只计算一次相似度矩阵和近邻索引,
+                指定了out_path时不使用缓存
         """
-        self.matrix = triad_to_matrix(triad, self._nan_symbol)  # 数据三元组转用户项目矩阵
+        self.matrix = triad_to_matrix(triad, self._nan_symbol,
+                                      sparse=True)  # 数据三元组转稀疏用户项目矩阵
         self.u_mean = nonzero_user_mean(
             self.matrix, self._nan_symbol)  # 根据用户项目矩阵计算每个用户调用项目的QoS均值
         self.i_mean = nonzero_item_mean(
             self.matrix, self._nan_symbol)  # 根据用户项目矩阵计算每个项目被用户调用的QoS均值
-        self.similarity_user_matrix, self.similarity_item_matrix = self.get_similarity_matrix(
-        )  # 获取用户相似度矩阵和项目相似度矩阵
+        if use_cache and out_path is None:
+            # 相同的训练数据直接读取缓存的相似度矩阵和近邻索引
+            user_cache = SimilarityCache(triad, "EPCC", self._nan_symbol,
+                                         "user")
+            item_cache = SimilarityCache(triad, "EPCC", self._nan_symbol,
+                                         "item")
+            self.similarity_user_matrix = user_cache.similarity_matrix(
+                lambda path: self._similarity_matrix(
+                    "user", block_size, memory_budget, path, n_jobs))
+            self.similarity_item_matrix = item_cache.similarity_matrix(
+                lambda path: self._similarity_matrix(
+                    "item", block_size, memory_budget, path, n_jobs))
+            self.user_neighbors = user_cache.neighbor_index(
+                self.similarity_user_matrix,
+                n_neighbors,
+                positive_only=True,
+                memory_budget=memory_budget)
+            self.item_neighbors = item_cache.neighbor_index(
+                self.similarity_item_matrix,
+                n_neighbors,
+                positive_only=True,
+                memory_budget=memory_budget)
+        else:
+            self.similarity_user_matrix, self.similarity_item_matrix = self.get_similarity_matrix(
+                block_size, memory_budget, out_path,
+                n_jobs)  # 获取用户相似度矩阵和项目相似度矩阵
+            # 构建用户和项目的近邻索引
+            self.user_neighbors = NeighborIndex.build(
+                self.similarity_user_matrix,
+                n_neighbors,
+                positive_only=True,
+                memory_budget=memory_budget)
+            self.item_neighbors = NeighborIndex.build(
+                self.similarity_item_matrix,
+                n_neighbors,
+                positive_only=True,
+                memory_budget=memory_budget)
 
-    def predict(self, triad, topk_u=-1, topk_i=-1, lamb=0.5):
-        y_list = []  # 真实评分
-        y_pred_list = []  # 预测评分
-        cold_boot_cnt = 0  # 冷启动统计
-        assert self.matrix is not None, "Please fit first e.g. model.fit()"
+    def predict_batch(self,
+                      uids,
+                      iids,
+                      topk_u=-1,
+                      topk_i=-1,
+                      lamb=0.5,
+                      batch_size=DEFAULT_PREDICT_BATCH_SIZE):
+        """批量预测
 
-        for row in tqdm(triad, desc="Predict... "):
-            uid, iid, rate = int(row[0]), int(row[1]), float(row[2])
-            # 冷启动: 新用户因为没有计算过相似用户, 因此无法预测评分, 新项目同理
-            if uid + 1 > self.matrix.shape[0] or iid + 1 > self.matrix.shape[1]:
-                cold_boot_cnt += 1
-                continue
+        Args:
+            uids (): 用户id数组
+            iids (): 项目id数组
+            topk_u (): 相似用户数量, -1表示不限制数量
+            topk_i (): 相似项目数量, -1表示不限制数量
+            lamb (): UPCC预测值的权重
+            batch_size (): 每次同时计算的预测数量
+
+        Returns:
+            (预测评分, 冷启动掩码), 冷启动的位置预测评分为nan
+        """
+        assert self.matrix is not None, "Please fit first e.g. model.fit()"
+        uids = np.asarray(uids, dtype=np.int64)
+        iids = np.asarray(iids, dtype=np.int64)
+        # 冷启动: 新用户因为没有计算过相似用户, 因此无法预测评分, 新项目同理
+        cold_start = (uids >= self.matrix.shape[0]) | (iids >=
+                                                       self.matrix.shape[1])
+        y_pred = np.full(len(uids), np.nan)
 
+        for start in tqdm(range(0, len(uids), batch_size),
+                          desc="Predict... "):
+            end = min(start + batch_size, len(uids))
+            warm = np.nonzero(~cold_start[start:end])[0] + start
+            uid, iid = uids[warm], iids[warm]
             u_mean = self.u_mean[uid]
             i_mean = self.i_mean[iid]
-            similarity_users = self.get_similarity_users(uid, topk_u)
-            similarity_items = self.get_similarity_items(iid, topk_i)
-
-            # 计算置信度
-            con_u = 0  # 用户置信度(user confidence weight)
-            con_i = 0  # 项目置信度(item confidence weight)
-            similarity_users_sum = sum([
-                self.similarity_user_matrix[sim_uid][uid]
-                for sim_uid in similarity_users
-            ])
-            similarity_items_sum = sum([
-                self.similarity_item_matrix[sim_iid][iid]
-                for sim_iid in similarity_items
-            ])
-            for sim_uid in similarity_users:
-                up = self.similarity_user_matrix[sim_uid][uid]
-                down = similarity_users_sum
-                con_u += (up /
-                          down) * self.similarity_user_matrix[sim_uid][uid]
-            for sim_iid in similarity_items:
-                up = self.similarity_item_matrix[sim_iid][iid]
-                down = similarity_items_sum
-                con_i += (up /
-                          down) * self.similarity_item_matrix[sim_iid][iid]
-            w_u = 1.0 * (con_u * lamb) / (con_u * lamb + con_i * (1.0 - lamb))
+            similarity_users, user_similarities = self.user_neighbors.batch_neighbors(
+                uid, topk_u)
+            similarity_items, item_similarities = self.item_neighbors.batch_neighbors(
+                iid, topk_i)
+            has_users = (similarity_users >= 0).any(axis=1)
+            has_items = (similarity_items >= 0).any(axis=1)
+
+            with np.errstate(divide="ignore", invalid="ignore"):
+                # 计算置信度
+                con_u = np.where(
+                    has_users, (user_similarities**2).sum(axis=1) /
+                    user_similarities.sum(axis=1),
+                    0)  # 用户置信度(user confidence weight)
+                con_i = np.where(
+                    has_items, (item_similarities**2).sum(axis=1) /
+                    item_similarities.sum(axis=1),
+                    0)  # 项目置信度(item confidence weight)
+                w_u = 1.0 * (con_u * lamb) / (con_u * lamb + con_i *
+                                              (1.0 - lamb))
+            # 相似用户和相似项目都不存在时置信度都为0, 按lamb加权
+            w_u = np.where(has_users | has_items, w_u, lamb)
             w_i = 1.0 - w_u
 
-            if len(similarity_users) == 0 and len(
-                    similarity_items) == 0:  # 相似用户和相似项目都不存在
-                y_pred = w_u * u_mean + w_i * i_mean
-            elif len(similarity_items) == 0:  # 只存在相似用户
-                y_pred = self._upcc(uid, iid, similarity_users, u_mean)
-            elif len(similarity_users) == 0:  # 只存在相似服务
-                y_pred = self._ipcc(uid, iid, similarity_items, i_mean)
-            else:  # 相似用户和相似项目都存在
-                y_pred = w_u * self._upcc(uid, iid, similarity_users, u_mean) + \
-                         w_i * self._ipcc(uid, iid, similarity_items, i_mean)
-            y_pred_list.append(y_pred)
-            y_list.append(rate)
-
-        print(f"cold boot :{cold_boot_cnt / len(triad) * 100:4f}%")
-        return y_list, y_pred_list
+            y_upcc = self._upcc(uid, iid, similarity_users, user_similarities,
+                                u_mean)
+            y_ipcc = self._ipcc(uid, iid, similarity_items, item_similarities,
+                                i_mean)
+            y_pred[warm] = np.select(
+                [
+                    ~has_users & ~has_items,  # 相似用户和相似项目都不存在
+                    ~has_items,  # 只存在相似用户
+                    ~has_users,  # 只存在相似服务
+                ],
+                [w_u * u_mean + w_i * i_mean, y_upcc, y_ipcc],
+                w_u * y_upcc + w_i * y_ipcc)  # 相似用户和相似项目都存在
+
+        return y_pred, cold_start
+
+    def predict(self, triad, topk_u=-1, topk_i=-1, lamb=0.5):
+        """预测评分
+
+        Returns:
+            (真实评分, 预测评分), 不包括冷启动的三元组
+        """
+        triad = np.asarray(triad)
+        y_pred, cold_start = self.predict_batch(triad[:, 0], triad[:, 1],
+                                                topk_u, topk_i, lamb)
+        print(f"cold boot :{cold_start.mean() * 100:4f}%")
+        return triad[~cold_start, 2].astype(np.float64), y_pred[~cold_start]
 
 
 if __name__ == "__main__":
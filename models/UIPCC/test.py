@@ -30,11 +30,13 @@ for density in [0.05, 0.1, 0.15, 0.2]:
     rt_data = MatrixDataset(type_)
     train_data, test_data = rt_data.split_train_test(density)
 
+    topk_u, topk_i = 30, 500
     uipcc = UIPCCModel()
-    uipcc.fit(train_data)
+    uipcc.fit(train_data,
+              n_neighbors=max(topk_u, topk_i))  # 近邻索引覆盖预测用的topk
 
     lamb = 0.8
-    y, y_pred = uipcc.predict(test_data, 30, 500, lamb)
+    y, y_pred = uipcc.predict(test_data, topk_u, topk_i, lamb)
 
     mae_ = mae(y, y_pred)
     mse_ = mse(y, y_pred)
@@ -1,4 +1,3 @@
-import copy
 import numpy as np
 import math
 from models import UMEAN
@@ -6,6 +5,10 @@ from numpy.core.defchararray import expandtabs
 from numpy.core.fromnumeric import nonzero
 from tqdm import tqdm
 from utils.model_util import nonzero_user_mean, triad_to_matrix
+from utils.similarity_cache import SimilarityCache
+from utils.similarity import (DEFAULT_N_NEIGHBORS, DEFAULT_PREDICT_BATCH_SIZE,
+                              NeighborIndex, pcc_similarity,
+                              weighted_deviation)
 
 # 相似度计算库
 from scipy.stats import pearsonr
@@ -18,33 +21,37 @@ class UPCCModel(object):
         self.matrix = None  # QoS矩阵
         self.u_mean = None  # 每个用户的评分均值
         self.similarity_matrix = None  # 用户相似度矩阵
+        self.neighbor_index = None  # 每个用户的前k个相似用户
         self._nan_symbol = -1  # 缺失项标记（数据集中使用-1表示缺失项）
 
-    def _get_similarity_matrix(self, matrix, metric):
+    def _get_similarity_matrix(self, matrix, metric, n_jobs=1):
         """获取项目相似度矩阵
 
         Args:
             matrix (): QoS矩阵
             metric (): 相似度计算方法, 可选参数: PCC(皮尔逊相关系数), COS(余弦相似度), ACOS(修正的余弦相似度)
+            n_jobs (): PCC计算使用的进程数, -1表示使用所有CPU核心
 
         """
-        _m = copy.deepcopy(matrix)
-        _m[_m == self._nan_symbol] = 0  # 将缺失项用0代替，以便之后计算
+        if metric == 'PCC':
+            # 基于掩码矩阵乘法的向量化实现, 结果与下面逐对计算的结果一致
+            return pcc_similarity(matrix.csr, n_jobs=n_jobs)
+
         n_users = matrix.shape[0]
         similarity_matrix = np.zeros((n_users, n_users))
 
         # 计算相似度矩阵
         for i in tqdm(range(n_users), desc="生成相似度矩阵"):
-            row_i = _m[i]
-            nonzero_i = np.nonzero(row_i)[0]  # 非0元素所对应的下标
+            row_i = matrix.dense_row(i)  # 缺失项用0代替，以便之后计算
+            nonzero_i = matrix.user_row(i)[0]  # 有评分的项目下标
             for j in range(i + 1, n_users):
-                row_j = _m[j]
-                nonzero_j = np.nonzero(row_j)[0]
-                intersect = np.intersect1d(nonzero_i,
-                                           nonzero_j)  # 用户i,j共同评分过的项目交集
+                nonzero_j = matrix.user_row(j)[0]
+                intersect = np.intersect1d(nonzero_i, nonzero_j,
+                                           assume_unique=True)  # 用户i,j共同评分过的项目交集
                 if len(intersect) == 0:
                     sim = 0
                 else:
+                    row_j = matrix.dense_row(j)
                     # 依据指定的相似度计算方法计算用户i,j的相似度
                     try:
                         if metric == 'PCC':
@@ -75,17 +82,10 @@ class UPCCModel(object):
             topk (): 相似用户数量, -1表示不限制数量
 
         Returns:
-            依照相似度从大到小排序, 与当前用户最为相似的前topk个相似用户
+            依照相似度从大到小排序, 与当前用户最为相似的前topk个相似用户及其相似度
 
         """
-        assert isinstance(topk, int)
-        ordered_sim_uid = (
-            -self.similarity_matrix[uid]).argsort()  # 按相似度从大到小排序后, 相似用户对应的索引
-        if topk == -1:
-            return ordered_sim_uid
-        else:
-            assert topk > 0
-            return ordered_sim_uid[:topk]
+        return self.neighbor_index.neighbors(uid, topk)
 
     def get_similarity(self, uid_a, uid_b):
         """传入两个uid，获取这两个用户的相似度
@@ -100,56 +100,92 @@ class UPCCModel(object):
 
         return self.similarity_matrix[uid_a][uid_b]
 
-    def fit(self, triad, metric='PCC'):
+    def fit(self,
+            triad,
+            metric='PCC',
+            n_neighbors=DEFAULT_N_NEIGHBORS,
+            n_jobs=1,
+            use_cache=True):
         """训练模型
 
         Args:
             triad (): 数据三元组: (uid, iid, rating)
             metric (): 相似度计算方法, 可选参数: PCC(皮尔逊相关系数), COS(余弦相似度), ACOS(修正的余弦相似度)
+            n_neighbors (): 近邻索引中为每个用户保存的相似用户数量, 预测时topK不超过该值则不需要重新排序
+            n_jobs (): 计算PCC相似度矩阵使用的进程数, -1表示使用所有CPU核心, 结果与单进程一致
+            use_cache (): 是否使用相似度缓存, 相同的训练数据和相似度计算方法只计算一次相似度矩阵和近邻索引
         """
-        self.matrix = triad_to_matrix(triad, self._nan_symbol)  # 数据三元组转QoS矩阵
+        self.matrix = triad_to_matrix(triad, self._nan_symbol,
+                                      sparse=True)  # 数据三元组转稀疏QoS矩阵
         self.u_mean = nonzero_user_mean(self.matrix,
                                         self._nan_symbol)  # 根据QoS矩阵计算每个用户的评分均值
-        self.similarity_matrix = self._get_similarity_matrix(
-            self.matrix, metric)  # 根据QoS矩阵获取用户相似矩阵
+        if use_cache:
+            cache = SimilarityCache(triad, metric, self._nan_symbol, "user")
+            self.similarity_matrix = cache.similarity_matrix(
+                lambda path: self._get_similarity_matrix(
+                    self.matrix, metric, n_jobs))  # 读取或计算用户相似矩阵
+            self.neighbor_index = cache.neighbor_index(
+                self.similarity_matrix, n_neighbors)  # 读取或构建每个用户的近邻索引
+        else:
+            self.similarity_matrix = self._get_similarity_matrix(
+                self.matrix, metric, n_jobs)  # 根据QoS矩阵获取用户相似矩阵
+            self.neighbor_index = NeighborIndex.build(
+                self.similarity_matrix, n_neighbors)  # 构建每个用户的近邻索引
+
+    def predict_batch(self,
+                      uids,
+                      iids,
+                      topK=-1,
+                      batch_size=DEFAULT_PREDICT_BATCH_SIZE):
+        """批量预测
 
-    def predict(self, triad, topK=-1):
-        y_list = []  # 真实评分
-        y_pred_list = []  # 预测评分
-        cold_boot_cnt = 0  # 冷启动统计
-        assert self.u_mean is not None, "Please fit first e.g. model.fit()"
+        Args:
+            uids (): 用户id数组
+            iids (): 项目id数组
+            topK (): 相似用户数量, -1表示不限制数量
+            batch_size (): 每次同时计算的预测数量
 
-        for row in tqdm(triad, desc="Predict... "):
-            uid, iid, rate = int(row[0]), int(row[1]), float(row[2])
-            # 冷启动: 新用户因为没有计算过相似用户, 因此无法预测评分
-            if uid + 1 > len(self.u_mean):
-                cold_boot_cnt += 1
-                continue
+        Returns:
+            (预测评分, 冷启动掩码), 冷启动的位置预测评分为nan
+        """
+        assert self.u_mean is not None, "Please fit first e.g. model.fit()"
+        uids = np.asarray(uids, dtype=np.int64)
+        iids = np.asarray(iids, dtype=np.int64)
+        # 冷启动: 新用户因为没有计算过相似用户, 因此无法预测评分
+        cold_start = uids >= len(self.u_mean)
+        y_pred = np.full(len(uids), np.nan)
+
+        for start in tqdm(range(0, len(uids), batch_size),
+                          desc="Predict... "):
+            end = min(start + batch_size, len(uids))
+            warm = np.nonzero(~cold_start[start:end])[0] + start
+            uid, iid = uids[warm], iids[warm]
             u_mean = self.u_mean[uid]  # 当前用户评分均值
-            similarity_users = self._get_similarity_users(uid, topK)
-            up = 0  # 分子
-            down = 0  # 分母
-            # 对于当前用户的每一个相似用户
-            for sim_uid in similarity_users:
-                sim_user_rate = self.matrix[sim_uid][iid]  # 相似用户对目标item的评分
-                similarity = self.get_similarity(uid, sim_uid)
-                # 如果相似用户对目标item没有评分，或者相似度为负，则不进行计算
-                if sim_user_rate == self._nan_symbol or similarity <= 0:
-                    continue
-                up += similarity * (sim_user_rate - self.u_mean[sim_uid]
-                                    )  # 相似度 * (相似用户评分 - 相似用户评分均值)
-                down += similarity
-
-            if down != 0:
-                y_pred = u_mean + up / down
-            else:
-                y_pred = u_mean
-
-            y_pred_list.append(y_pred)
-            y_list.append(rate)
-
-        print(f"cold boot :{cold_boot_cnt / len(triad) * 100:4f}%")
-        return y_list, y_pred_list
+            sim_uids, similarities = self.neighbor_index.batch_neighbors(
+                uid, topK)
+            sim_user_rates = self.matrix.get(sim_uids,
+                                             iid[:, None])  # 相似用户对目标item的评分
+            # 如果相似用户对目标item没有评分，或者相似度为负，则不进行计算
+            valid = (sim_uids >= 0) & (sim_user_rates != self._nan_symbol) & (
+                similarities > 0)
+            up, down = weighted_deviation(sim_uids, similarities,
+                                          sim_user_rates, self.u_mean, valid)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                y_pred[warm] = np.where(down != 0, u_mean + up / down, u_mean)
+
+        return y_pred, cold_start
+
+    def predict(self, triad, topK=-1):
+        """预测评分
+
+        Returns:
+            (真实评分, 预测评分), 不包括冷启动的三元组
+        """
+        triad = np.asarray(triad)
+        y_pred, cold_start = self.predict_batch(triad[:, 0], triad[:, 1],
+                                                topK)
+        print(f"cold boot :{cold_start.mean() * 100:4f}%")
+        return triad[~cold_start, 2].astype(np.float64), y_pred[~cold_start]
 
 
 def adjusted_cosine_similarity(x, y, intersect, id_x, id_y, u_mean):
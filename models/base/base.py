@@ -1,13 +1,16 @@
 import os
 import time
+
+import numpy as np
 import torch
+from torch import nn
 from torch.utils.tensorboard import SummaryWriter
 from tensorboard import program
 from tqdm import tqdm
 
 from root import absolute
 from utils.evaluation import mae, mse, rmse
-from utils.model_util import load_checkpoint, save_checkpoint
+from utils.model_util import CheckpointManager, load_checkpoint
 from utils.mylogger import TNLog
 
 from .utils import train_single_epoch_with_dataloader, train_mult_epochs_with_dataloader
@@ -26,8 +29,8 @@ class ModelBase(object):
         # 获取当前时间
         self.date = time.strftime("%Y-%m-%d_%H-%M-%S", time.localtime())
 
-        # 保存训练过程中的模型参数，用于预测使用
-        self.saved_model_ckpt = []
+        # 保存训练过程中最优的若干个模型参数，用于预测使用, 在fit中创建
+        self.checkpoints = None
 
         # Tensorboard
         # 自动打开tensorboard，只要浏览器中打开localhost:6006即可看到训练过程
@@ -38,9 +41,13 @@ class ModelBase(object):
         # tensorboard.configure(argv=[None, '--logdir', save_dir])
         # tensorboard.launch()
 
-    def fit(self, train_loader, epochs, optimizer, eval_=True, eval_loader=None, save_model=True, save_filename=""):
+    def fit(self, train_loader, epochs, optimizer, eval_=True, eval_loader=None, save_model=True, save_filename="",
+            eval_interval=10, keep_checkpoints=3):
         """Eval为True: 自动保存最优模型（推荐）, save_model为True: 间隔epoch后自动保存模型
 
+        每个batch的loss累加在device上, 每个epoch只读取一次, 避免每个batch都同步一次;
+        每个epoch的训练吞吐量(samples/sec)写入TensorBoard
+
         Args:
             train_loader : 训练集
             epochs : 迭代次数
@@ -49,18 +56,24 @@ class ModelBase(object):
             eval_loader : 验证集数据 Defaults to None. 
             save_model :  是否保存模型 Defaults to True.
             save_filename :  保存的模型的名字 Defaults to "".
+            eval_interval : 每隔多少个epoch验证(或保存)一次 Defaults to 10.
+            keep_checkpoints : 保留loss最小的几个checkpoint Defaults to 3.
         """
+        assert eval_interval > 0
+        if self.checkpoints is None:
+            self.checkpoints = CheckpointManager(f"output/{self.name}/{self.date}/saved_model", keep_checkpoints)
         self.model.train()
         self.model.to(self.device)
         train_loss_list = []
         eval_loss_list = []
-        best_loss = None
         self.optimizer = optimizer
 
         # 训练
         for epoch in tqdm(range(epochs)):
-            train_batch_loss = 0
-            eval_total_loss = 0
+            train_batch_loss = torch.zeros((), device=self.device)
+            eval_total_loss = torch.zeros((), device=self.device)
+            n_samples = 0
+            start = time.perf_counter()
             for batch_id, batch in enumerate(train_loader):
 
                 users, items, ratings = batch[0].to(self.device), batch[1].to(self.device), batch[2].to(self.device)
@@ -72,65 +85,54 @@ class ModelBase(object):
                 loss.backward()
                 self.optimizer.step()
 
-                train_batch_loss += loss.item()
+                train_batch_loss += loss.detach()
+                n_samples += len(ratings)
 
-            loss_per_epoch = train_batch_loss / len(train_loader)
+            # 每个epoch只在这里同步一次, 计时放在同步之后
+            loss_per_epoch = train_batch_loss.item() / len(train_loader)
+            samples_per_sec = n_samples / (time.perf_counter() - start)
             train_loss_list.append(loss_per_epoch)
 
             self.logger.info(f"Training Epoch:[{epoch + 1}/{epochs}] Loss:{loss_per_epoch:.4f}")
             self.writer.add_scalar("Training Loss", loss_per_epoch, epoch + 1)
+            self.writer.add_scalar("Samples/sec", samples_per_sec, epoch + 1)
 
             # 验证
-            if (epoch + 1) % 10 == 0:
+            if (epoch + 1) % eval_interval == 0:
                 if eval_ == True:
                     assert eval_loader is not None, "Please offer eval dataloader"
                     self.model.eval()
                     with torch.no_grad():
-                        for batch_id, batch in tqdm(enumerate(eval_loader)):
+                        for batch_id, batch in enumerate(eval_loader):
                             user, item, rating = batch[0].to(self.device), \
                                                  batch[1].to(self.device), \
                                                  batch[2].to(self.device)
                             y_pred = self.model(user, item)
                             y_real = rating.reshape(-1, 1)
                             loss = self.loss_fn(y_pred, y_real)
-                            eval_total_loss += loss.item()
-                        loss_per_epoch = eval_total_loss / len(eval_loader)
-
-                        if best_loss is None:
-                            best_loss = loss_per_epoch
-                            is_best = True
-                        elif loss_per_epoch < best_loss:
-                            best_loss = loss_per_epoch
-                            is_best = True
-                        else:
-                            is_best = False
+                            eval_total_loss += loss
+                        loss_per_epoch = eval_total_loss.item() / len(eval_loader)
+
                         eval_loss_list.append(loss_per_epoch)
                         self.logger.info(f"Test loss: {loss_per_epoch}")
                         self.writer.add_scalar("Eval loss", loss_per_epoch, epoch)
-                        # 保存最优的loss
-                        if is_best:
-                            ckpt = {
-                                "model": self.model.state_dict(),
-                                "epoch": epoch + 1,
-                                "optim": optimizer.state_dict(),
-                                "best_loss": best_loss
-                            }
-                        # else:
-                        #     ckpt = {}
-                        save_checkpoint(ckpt, is_best, f"output/{self.name}/{self.date}/saved_model",
-                                        f"{save_filename}_loss_{best_loss:.4f}.ckpt")
-                        self.saved_model_ckpt.append(ckpt)
+                        # 只保留loss最小的几个模型
+                        self._save_checkpoint(epoch, loss_per_epoch, save_filename)
 
                 elif save_model:
-                    ckpt = {
-                        "model": self.model.state_dict(),
-                        "epoch": epoch + 1,
-                        "optim": optimizer.state_dict(),
-                        "best_loss": loss_per_epoch
-                    }
-                    save_checkpoint(ckpt, save_model, f"output/{self.name}/{self.date}/saved_model",
-                                    f"{save_filename}_loss_{loss_per_epoch:.4f}.ckpt")
-                    self.saved_model_ckpt.append(ckpt)
+                    self._save_checkpoint(epoch, loss_per_epoch, save_filename)
+
+        # 等待写入完成并关闭写文件的线程, 再次fit时重新创建
+        self.checkpoints.close()
+
+    def _save_checkpoint(self, epoch, loss, save_filename):
+        ckpt = {
+            "model": self.model.state_dict(),
+            "epoch": epoch + 1,
+            "optim": self.optimizer.state_dict(),
+            "best_loss": loss
+        }
+        self.checkpoints.save(ckpt, loss, f"{save_filename}_epoch_{epoch + 1}_loss_{loss:.4f}.ckpt")
 
     def predict(self, test_loader, resume=False, path=None):
         """模型预测
@@ -150,8 +152,9 @@ class ModelBase(object):
             if path:
                 ckpt = load_checkpoint(path)
             else:
-                models = sorted(self.saved_model_ckpt, key=lambda x: x['best_loss'])
-                ckpt = models[0]
+                assert self.checkpoints is not None and self.checkpoints.best() is not None, \
+                    "No checkpoint saved, please fit first"
+                ckpt = self.checkpoints.best()
             self.model.load_state_dict(ckpt['model'])
             self.logger.info(f"last checkpoint restored! ckpt: loss {ckpt['best_loss']:.4f} Epoch {ckpt['epoch']}")
 
@@ -172,6 +175,69 @@ class ModelBase(object):
 
         return torch.cat(y_list).cpu().numpy(), torch.cat(y_pred_list).cpu().numpy()
 
+    def fold_in_embeddings(self, side):
+        """fold-in时需要增加一行的embedding层, 由子类实现
+
+        Args:
+            side : "user"或"item"
+
+        Returns:
+            list: nn.Embedding的列表
+        """
+        raise NotImplementedError
+
+    def fold_in(self, side, ids, rates, steps=50, lr=0.01):
+        """新用户/新服务的fold-in: 在embedding层中增加一行, 冻结其他参数, 只对这一行做几步梯度下降
+
+        新增的参数会替换原来的embedding参数, fold-in之后继续训练需要重新创建优化器
+
+        Args:
+            side : "user"为新用户, "item"为新服务
+            ids : 新用户调用过的服务id(或调用过新服务的用户id)
+            rates : 对应的QoS值
+            steps : 梯度下降的步数. Defaults to 50.
+            lr : 学习率. Defaults to 0.01.
+
+        Returns:
+            int: 新用户的uid(或新服务的iid)
+        """
+        assert side in ("user", "item"), f"unknown side: {side}"
+        embeddings = self.fold_in_embeddings(side)
+        self.model.to(self.device)
+        new_id = embeddings[0].num_embeddings
+        for embedding in embeddings:
+            weight = embedding.weight.data
+            # 新增的一行初始化为已有embedding的均值
+            embedding.weight = nn.Parameter(
+                torch.cat([weight, weight.mean(dim=0, keepdim=True)]))
+            embedding.num_embeddings += 1
+        if len(ids) == 0:
+            return new_id
+
+        others = torch.as_tensor(np.asarray(ids), dtype=torch.long, device=self.device)
+        new = torch.full_like(others, new_id)
+        users, items = (new, others) if side == "user" else (others, new)
+        y_real = torch.as_tensor(np.asarray(rates), dtype=torch.float32,
+                                 device=self.device).reshape(-1, 1)
+
+        params = [embedding.weight for embedding in embeddings]
+        requires_grad = [p.requires_grad for p in self.model.parameters()]
+        for p in self.model.parameters():
+            p.requires_grad_(False)
+        for p in params:
+            p.requires_grad_(True)
+        # 梯度只在新增的一行上非零, Adam对梯度为零的行不做更新
+        optimizer = torch.optim.Adam(params, lr=lr)
+        self.model.eval()
+        for _ in range(steps):
+            optimizer.zero_grad()
+            loss = self.loss_fn(self.model(users, items), y_real)
+            loss.backward()
+            optimizer.step()
+        for p, flag in zip(self.model.parameters(), requires_grad):
+            p.requires_grad_(flag)
+        return new_id
+
 
 class MemoryBase(object):
     def __init__(self) -> None:
@@ -1,45 +1,179 @@
 import copy
+import threading
 from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool
 from typing import Dict, List
 
 import numpy as np
+import torch
+from torch import nn
+from torch.nn.utils import parameters_to_vector
 from tqdm import tqdm
 
 from utils.model_util import use_optimizer
+from utils.parallel import get_n_jobs
 
 from .utils import train_mult_epochs_with_dataloader
 
 
+def embedding_columns(model):
+    """模型中用户/项目embedding表的参数名, 以及表的行id对应三元组中的哪一列
+
+    Returns:
+        dict: {参数名: 0(uid) 或 1(iid)}, 按模块名中的user/item区分
+    """
+    columns = {}
+    for name, module in model.named_modules():
+        if not isinstance(module, nn.Embedding):
+            continue
+        if "user" in name:
+            columns[f"{name}.weight"] = 0
+        elif "item" in name:
+            columns[f"{name}.weight"] = 1
+    return columns
+
+
+class ParamLayout(object):
+    """模型参数与一维float32向量之间的对应关系
+
+    向量按parameters_to_vector的顺序拼接各个参数, client上传和服务端融合都使用这个向量,
+    unflatten得到的state_dict中每一项都是向量的view, 不复制数据.
+    sparse_keys中的embedding表不放进向量, client只上传本地数据用到的行(见SparseUpdate).
+
+    Args:
+        model : 模型, 只支持没有buffer的模型(state_dict中只有参数)
+        sparse_keys : 按行稀疏上传的embedding表, {参数名: 行id在三元组中的列}. Defaults to None.
+    """
+    def __init__(self, model, sparse_keys=None) -> None:
+        named = list(model.named_parameters())
+        assert [k for k, _ in named] == list(model.state_dict().keys()), \
+            "state_dict should only contain parameters"
+        self.sparse_keys = dict(sparse_keys or {})
+        named = [(k, p) for k, p in named if k not in self.sparse_keys]
+        self.keys = [k for k, _ in named]
+        self.shapes = [p.shape for _, p in named]
+        self.offsets = np.concatenate(([0], np.cumsum([p.numel() for _, p in named])))
+        self.size = int(self.offsets[-1])
+
+    def flatten(self, model):
+        """模型参数(不包括sparse_keys)拷贝成一个连续的float32向量
+        """
+        params = [
+            p for k, p in model.named_parameters() if k not in self.sparse_keys
+        ]
+        return parameters_to_vector(params).detach().float()
+
+    def unflatten(self, vec):
+        return OrderedDict(
+            (k, vec[start:end].view(shape))
+            for k, shape, start, end in zip(self.keys, self.shapes,
+                                            self.offsets[:-1], self.offsets[1:]))
+
+
+class SparseUpdate(object):
+    """client上传的参数: 稠密参数的一维向量, 以及embedding表中本地数据用到的行的变化量
+
+    上传的大小只与client用到的用户和服务数有关, 与embedding表的行数无关.
+
+    Args:
+        dense : ParamLayout.flatten得到的一维向量
+        rows : {参数名: (行id, 这些行训练后减去训练前的值)}
+    """
+    def __init__(self, dense, rows) -> None:
+        self.dense = dense
+        self.rows = rows
+
+
+class WorkerModels(object):
+    """所有client共享的工作模型, 每个线程(进程)一个
+
+    client只保存自己的数据和少量私有状态, 被调度时把服务端参数载入当前线程的工作模型再训练,
+    不需要为每个client复制一份模型.
+
+    Args:
+        model : 模型结构的模板, 第一次在某个线程中使用时复制一份
+        sparse_keys : 按行稀疏上传的embedding表, 见ParamLayout. Defaults to None.
+    """
+    def __init__(self, model, sparse_keys=None) -> None:
+        self.template = model
+        self.layout = ParamLayout(model, sparse_keys)
+        self._local = threading.local()
+
+    def get(self):
+        model = getattr(self._local, "model", None)
+        if model is None:
+            model = copy.deepcopy(self.template)
+            self._local.model = model
+        return model
+
+    def __getstate__(self):
+        return {"template": self.template, "layout": self.layout}
+
+    def __setstate__(self, state):
+        self.template = state["template"]
+        self.layout = state["layout"]
+        self._local = threading.local()
+
+
 class ClientBase(object):
-    def __init__(self, device, model) -> None:
+    def __init__(self, device, model: WorkerModels) -> None:
         self.device = device
-        self.model = model
+        self.model = model  # 共享的工作模型
         self.data_loader = None
+        self._rows = None  # 本地数据中的(uid, iid), 第一次上传时计算
         super().__init__()
 
     def fit(self, params, loss_fn, optimizer: str, lr, epochs=5):
-        self.model.load_state_dict(params)
-        self.model.train()
-        self.model.to(self.device)
-        opt = use_optimizer(self.model, optimizer, lr)
+        model = self.model.get()
+        model.load_state_dict(params)
+        model.train()
+        model.to(self.device)
+        opt = use_optimizer(model, optimizer, lr)
         loss, lis = train_mult_epochs_with_dataloader(
             epochs,
-            model=self.model,
+            model=model,
             device=self.device,
             dataloader=self.data_loader,
             opt=opt,
             loss_fn=loss_fn)
         self.loss_list = [*lis]
-        return self.model.state_dict(), round(loss, 4)
+        # 工作模型会被下一个client覆盖, 返回参数拷贝成的一维向量
+        layout = self.model.layout
+        flat_params = layout.flatten(model)
+        if layout.sparse_keys:
+            flat_params = SparseUpdate(flat_params,
+                                       self._touched_rows(model, params))
+        return flat_params, round(loss, 4)
+
+    def _touched_rows(self, model, params):
+        """本地数据用到的embedding行及其变化量, 其余的行没有来自本地数据的梯度, 不上传
+        """
+        if self._rows is None:
+            self._rows = (torch.unique(self.data_loader.user_tensor),
+                          torch.unique(self.data_loader.item_tensor))
+        state = model.state_dict()
+        rows = {}
+        for key, column in self.model.layout.sparse_keys.items():
+            idx = self._rows[column]
+            new = state[key].detach()[idx.to(state[key].device)]
+            old = params[key][idx.to(params[key].device)].to(new.device)
+            rows[key] = (idx, new - old)
+        return rows
 
 
 class ClientsBase(object):
     """多client 的虚拟管理节点
     """
+    sparse_embeddings = True  # client只上传用到的用户/项目embedding行
+
     def __init__(self, triad, model, device) -> None:
         super().__init__()
         self.triad = triad
         self.model = model
+        sparse_keys = embedding_columns(
+            model) if self.sparse_embeddings else None
+        self.worker_models = WorkerModels(model, sparse_keys)
         self.device = device
         self.clients_map = {}  # 存储每个client的数据集
 
@@ -70,48 +204,216 @@ class ClientsBase(object):
 
 
 class ServerBase(object):
+    """服务端融合client上传的一维参数向量, layout用于把融合结果还原成state_dict
+
+    layout中的embedding表保存在tables中, 只按client上传的行原地更新:
+    table[r] += sum(c * (x_c[r] - table[r])), 与对整张表加权平均的结果相同(没有上传的行视为未改变).
+    """
     def __init__(self) -> None:
         super().__init__()
+        self.layout = None
+        self.flat_params = None
+        self.tables = None
 
-    def upgrade_wich_cefficients(self, params: List[Dict], coefficients: Dict):
-        """使用加权平均对参数进行更新
+    def set_layout(self, layout, s_params):
+        """设置client上传参数的布局
 
         Args:
-            params : 模型参数
-            coefficients : 加权平均的系数
+            layout : ParamLayout
+            s_params : 本轮下发给client的参数, 不是服务端自己的参数时(第一轮)从中复制embedding表
         """
+        self.layout = layout
+        if layout.sparse_keys and s_params is not getattr(
+                self, "params", None):
+            self.tables = {
+                k: s_params[k].detach().clone()
+                for k in layout.sparse_keys
+            }
+
+    def upgrade_wich_cefficients(self, params: List[torch.Tensor],
+                                 coefficients: List[float]):
+        """使用加权平均对参数进行更新, 每个client一次原地的 flat_params += c * param
 
-        o = OrderedDict()
+        Args:
+            params : client上传的一维参数向量(或SparseUpdate)
+            coefficients : 加权平均的系数
+        """
         if len(params) != 0:
-            # 获得不同的键
-            for k, v in params[0].items():
-                for it, param in enumerate(params):
-                    if it == 0:
-                        o[k] = coefficients[it] * param[k]
-                    else:
-                        o[k] += coefficients[it] * param[k]
-            self.params = o
-
-    def upgrade_average(self, params: List[Dict]):
-        o = OrderedDict()
+            o = torch.zeros_like(_dense(params[0]))
+            for coefficient, param in zip(coefficients, params):
+                o.add_(_dense(param), alpha=coefficient)
+            self._upgrade_rows(params, coefficients)
+            self._set_flat_params(o)
+
+    def upgrade_average(self, params: List[torch.Tensor]):
         if len(params) != 0:
-            for k, v in params[0].items():
-                o[k] = sum([i[k] for i in params]) / len(params)
-            self.params = o
+            o = torch.zeros_like(_dense(params[0]))
+            for param in params:
+                o.add_(_dense(param))
+            self._upgrade_rows(params, [1 / len(params)] * len(params))
+            self._set_flat_params(o.div_(len(params)))
+
+    def _upgrade_rows(self, params, coefficients):
+        """按行原地累加各client上传的embedding变化量
+        """
+        if not isinstance(params[0], SparseUpdate):
+            return
+        for coefficient, param in zip(coefficients, params):
+            for key, (idx, delta) in param.rows.items():
+                table = self.tables[key]
+                table.index_add_(0,
+                                 idx.to(table.device),
+                                 delta.to(table.device),
+                                 alpha=coefficient)
+
+    def _set_flat_params(self, flat_params):
+        assert self.layout is not None, "layout should be set before upgrade"
+        self.flat_params = flat_params
+        params = self.layout.unflatten(flat_params)
+        if self.layout.sparse_keys:
+            params.update(self.tables)
+        self.params = params
+
+
+def _dense(param):
+    return param.dense if isinstance(param, SparseUpdate) else param
+
+
+CLIENT_EXECUTOR_BACKENDS = ("serial", "thread", "process")
+
+
+def client_seed(base_seed, round_, uid):
+    """由执行器的种子、轮数和uid确定每个client本地训练的随机种子, 与训练的先后顺序无关
+    """
+    seed_seq = np.random.SeedSequence([base_seed, round_, int(uid)])
+    return int(seed_seq.generate_state(1)[0])
+
+
+def _fit_client(client, s_params, loss_fn, optimizer, lr, seed):
+    torch.manual_seed(seed)
+    params, loss = client.fit(s_params, loss_fn, optimizer, lr)
+    return params, loss, client.loss_list
+
+
+# 子进程中的client状态, 在创建进程池时传入一次
+_client_worker_state = {}
+
+
+def _init_client_worker(clients, loss_fn, optimizer):
+    torch.set_num_threads(1)  # 每个进程训练一个client, 避免线程数超过CPU核心数
+    _client_worker_state["clients"] = clients
+    _client_worker_state["loss_fn"] = loss_fn
+    _client_worker_state["optimizer"] = optimizer
+
+
+def _client_worker(job):
+    uid, s_params, lr, seed = job
+    return _fit_client(_client_worker_state["clients"][uid], s_params,
+                       _client_worker_state["loss_fn"],
+                       _client_worker_state["optimizer"], lr, seed)
+
+
+class ClientExecutor(object):
+    """训练被选择的client的执行器
+
+    每个client从服务端下发的同一份参数开始训练, 训练前用client_seed设置随机种子,
+    返回结果按uid的顺序排列, 因此结果与client完成的先后顺序无关.
+
+    Args:
+        backend : serial(串行), thread(线程池), process(进程池, 每个进程持有一份clients, 只支持CPU).
+            thread后端中各线程共享torch的全局随机数状态, 模型中有Dropout时结果不保证可复现. Defaults to "serial".
+        n_jobs : 线程数或进程数, -1表示使用所有CPU核心. Defaults to -1.
+        seed : 随机种子, None时从np.random中取一个(freeze_random之后是确定的). Defaults to None.
+    """
+    def __init__(self, backend="serial", n_jobs=-1, seed=None) -> None:
+        assert backend in CLIENT_EXECUTOR_BACKENDS, f"unknown backend: {backend}"
+        self.backend = backend
+        self.n_jobs = get_n_jobs(n_jobs)
+        self.seed = int(np.random.randint(2**31)) if seed is None else seed
+        self.round = 0
+        self._pool = None
+        self._pool_clients = None
+
+    def map(self, clients, uids, s_params, loss_fn, optimizer, lr):
+        """训练一轮被选择的client
+
+        Returns:
+            list: [(参数, loss, 每个本地epoch的loss)], 与uids的顺序相同
+        """
+        seeds = [client_seed(self.seed, self.round, uid) for uid in uids]
+        self.round += 1
+        if self.backend == "serial":
+            return [
+                _fit_client(clients[uid], s_params, loss_fn, optimizer, lr,
+                            seed)
+                for uid, seed in tqdm(zip(uids, seeds),
+                                      total=len(uids),
+                                      desc="Client training")
+            ]
+        if self.backend == "thread":
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.n_jobs)
+            results = self._pool.map(
+                lambda job: _fit_client(clients[job[0]], s_params, loss_fn,
+                                        optimizer, lr, job[1]),
+                zip(uids, seeds))
+        else:
+            if self._pool is None or self._pool_clients is not clients:
+                self.close()
+                self._pool = Pool(self.n_jobs,
+                                  initializer=_init_client_worker,
+                                  initargs=(clients, loss_fn, optimizer))
+                self._pool_clients = clients
+            jobs = [(uid, s_params, lr, seed) for uid, seed in zip(uids, seeds)]
+            results = self._pool.imap(_client_worker, jobs)
+        return list(tqdm(results, total=len(uids), desc="Client training"))
+
+    def close(self):
+        if self._pool is None:
+            return
+        if self.backend == "thread":
+            self._pool.shutdown()
+        else:
+            self._pool.close()
+            self._pool.join()
+        self._pool = None
+        self._pool_clients = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
 
 class FedModelBase(object):
+    executor = None  # 训练client的执行器, None时使用串行的ClientExecutor
+
+    def set_executor(self, backend="serial", n_jobs=-1, seed=None):
+        """设置训练client的方式, 参数见ClientExecutor
+        """
+        if self.executor is not None:
+            self.executor.close()
+        self.executor = ClientExecutor(backend, n_jobs, seed)
+
     def update_selected_clients(self, sampled_client_indices, lr, s_params):
-        """使用 client.fit 函数来训练被选择的client
+        """使用 client.fit 函数来训练被选择的client, 每个client都从服务端的参数s_params开始训练
         """
+        if self.executor is None:
+            self.executor = ClientExecutor("serial")
+        # 服务端按client上传向量的布局还原state_dict
+        self.server.set_layout(self.clients.worker_models.layout, s_params)
+        results = self.executor.map(self.clients, sampled_client_indices,
+                                    s_params, self.loss_fn, self.optimizer,
+                                    lr)
         collector = []
         client_loss = []
         selected_total_size = 0  # client数据集总数
 
-        for uid in tqdm(sampled_client_indices, desc="Client training"):
-            s_params, loss = self.clients[uid].fit(s_params, self.loss_fn,
-                                                   self.optimizer, lr)
-            collector.append(s_params)
+        for uid, (params, loss, loss_list) in zip(sampled_client_indices,
+                                                  results):
+            self.clients[uid].loss_list = loss_list
+            collector.append(params)
             client_loss.append(loss)
             selected_total_size += self.clients[uid].n_item
         return collector, client_loss, selected_total_size
@@ -0,0 +1,668 @@
+from multiprocessing import Pool
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from utils.parallel import SharedArray, get_n_jobs
+"""
+    Vectorized training kernels shared by the matrix factorization models
+"""
+
+
+def split_triad(triad):
+    """将三元组拆成类型确定的三列: (uid, iid, rate)
+    """
+    triad = np.asarray(triad)
+    return (triad[:, 0].astype(np.int64), triad[:, 1].astype(np.int64),
+            triad[:, 2].astype(np.float64))
+
+
+def sgd_epoch(user_vec,
+              item_vec,
+              uids,
+              iids,
+              rates,
+              lr,
+              lambda_,
+              batch_size=1,
+              user_delta=None,
+              item_delta=None,
+              lambda_item=None):
+    """按顺序对所有评分做一轮mini-batch SGD
+
+    每个batch内的误差和梯度都基于batch开始时的参数计算, 同一个用户/项目的梯度用np.add.at累加,
+    batch_size=1时与逐条更新完全一致. 正则项对每一条评分计算一次, 因此学习率不需要随batch_size调整.
+
+    Args:
+        user_vec : (n_user, latent_dim)的用户特征矩阵, 原地更新
+        item_vec : (n_item, latent_dim)的项目特征矩阵, 原地更新
+        uids, iids, rates : 训练数据的三列
+        lr : 学习率
+        lambda_ : 用户特征的正则化系数(lambda_item为None时也用于项目特征),
+            可以是每个用户一个系数的数组(见per_row_lambda)
+        batch_size : 每个batch的评分数量. Defaults to 1.
+        user_delta, item_delta : 与特征矩阵形状相同的数组, 不为None时累加本轮参数的变化量, 用于判断收敛
+        lambda_item : 项目特征的正则化系数, 可以是每个项目一个系数的数组, None表示与lambda_相同. Defaults to None.
+    """
+    lambda_user = lambda_
+    if lambda_item is None:
+        lambda_item = lambda_
+    per_user = np.ndim(lambda_user) != 0
+    per_item = np.ndim(lambda_item) != 0
+    if batch_size == 1:
+        # 逐条更新时numpy的批量操作反而更慢, 直接对单行做向量运算
+        for u, i, y in zip(uids, iids, rates):
+            p, q = user_vec[u], item_vec[i]
+            e = y - p @ q
+            lam_u = lambda_user[u] if per_user else lambda_user
+            lam_i = lambda_item[i] if per_item else lambda_item
+            user_step = lr * (e * q - lam_u * p)
+            item_step = lr * (e * p - lam_i * q)
+            user_vec[u] += user_step
+            item_vec[i] += item_step
+            if user_delta is not None:
+                user_delta[u] += user_step
+            if item_delta is not None:
+                item_delta[i] += item_step
+        return
+
+    for start in range(0, len(rates), batch_size):
+        u = uids[start:start + batch_size]
+        i = iids[start:start + batch_size]
+        p, q = user_vec[u], item_vec[i]
+        e = rates[start:start + batch_size] - np.einsum("ij,ij->i", p, q)
+        lam_u = lambda_user[u][:, None] if per_user else lambda_user
+        lam_i = lambda_item[i][:, None] if per_item else lambda_item
+        # 梯度下降的更新量: -lr * (-e * q + lambda * p)
+        user_step = lr * (e[:, None] * q - lam_u * p)
+        item_step = lr * (e[:, None] * p - lam_i * q)
+        np.add.at(user_vec, u, user_step)
+        np.add.at(item_vec, i, item_step)
+        if user_delta is not None:
+            np.add.at(user_delta, u, user_step)
+        if item_delta is not None:
+            np.add.at(item_delta, i, item_step)
+
+
+def per_row_lambda(lambda_, ids, n_rows):
+    """把正则化系数平摊到每一行的每条评分上: lambda_ / 该行的评分数
+
+    sgd_epoch对每条评分计算一次正则项, 一轮下来第i行的惩罚为lambda_ * n_i.
+    使用平摊后的系数时一轮的惩罚为lambda_, 与als_solve(weighted=False)的目标函数相同.
+
+    Returns:
+        np.ndarray: (n_rows,)的正则化系数
+    """
+    counts = np.bincount(ids, minlength=n_rows)
+    return lambda_ / np.maximum(counts, 1)
+
+
+def nmf_sgd_epoch(user_vec,
+                  item_vec,
+                  uids,
+                  iids,
+                  rates,
+                  lr,
+                  batch_size=1,
+                  user_delta=None,
+                  item_delta=None):
+    """非负矩阵分解的一轮投影SGD
+
+    先更新用户特征并将负值置0, 再用更新后的用户特征更新项目特征并将负值置0,
+    batch_size=1时与逐条更新完全一致
+
+    Args:
+        参数含义同sgd_epoch, 非负矩阵分解不使用正则项
+    """
+    if batch_size == 1:
+        for u, i, y in zip(uids, iids, rates):
+            p, q = user_vec[u], item_vec[i]
+            e = y - p @ q
+            old_p, old_q = p.copy(), q.copy()
+            p += lr * (e * q)
+            p[p < 0] = 0
+            q += lr * (e * p)
+            q[q < 0] = 0
+            if user_delta is not None:
+                user_delta[u] += p - old_p
+            if item_delta is not None:
+                item_delta[i] += q - old_q
+        return
+
+    for start in range(0, len(rates), batch_size):
+        u = uids[start:start + batch_size]
+        i = iids[start:start + batch_size]
+        e = rates[start:start + batch_size] - np.einsum(
+            "ij,ij->i", user_vec[u], item_vec[i])
+        _projected_add(user_vec, u, lr * e[:, None] * item_vec[i], user_delta)
+        _projected_add(item_vec, i, lr * e[:, None] * user_vec[u], item_delta)
+
+
+def _projected_add(vec, rows, step, delta=None):
+    """np.add.at之后将被更新的行中的负值置0, delta不为None时累加实际的变化量
+    """
+    touched = np.unique(rows)
+    old = vec[touched]
+    np.add.at(vec, rows, step)
+    updated = vec[touched]
+    np.maximum(updated, 0, out=updated)
+    vec[touched] = updated
+    if delta is not None:
+        delta[touched] += updated - old
+
+
+def masked_product(m, user_vec, item_vec):
+    """只在观测位置上计算 user_vec @ item_vec.T, 结果与m的稀疏结构相同
+
+    Args:
+        m : 观测矩阵(CSR)
+        user_vec, item_vec : 特征矩阵
+    """
+    rows = np.repeat(np.arange(m.shape[0]), np.diff(m.indptr))
+    data = np.einsum("ij,ij->i", user_vec[rows], item_vec[m.indices])
+    return csr_matrix((data, m.indices, m.indptr), shape=m.shape)
+
+
+def nmf_mu_step(m, user_vec, item_vec, lambda_=0, eps=1e-9):
+    """带掩码的乘法更新(multiplicative update)NMF的一次迭代
+
+    目标函数只包含观测位置: ||M * (R - W H^T)||^2 + lambda * (||W||^2 + ||H||^2),
+    W <- W * (R H) / ((M * W H^T) H + lambda W),
+    H <- H * (R^T W) / ((M * W H^T)^T W + lambda H),
+    其中 M * W H^T 只在观测位置计算, 每次迭代只需要几次稀疏矩阵乘法
+
+    Args:
+        m : 观测矩阵(CSR), 未观测的位置不存储
+        user_vec : (n_user, latent_dim)的非负用户特征矩阵W
+        item_vec : (n_item, latent_dim)的非负项目特征矩阵H
+        lambda_ : 正则化系数
+        eps : 防止分母为0
+
+    Returns:
+        (新的用户特征矩阵, 新的项目特征矩阵)
+    """
+    pred = masked_product(m, user_vec, item_vec)
+    user_vec = user_vec * (m @ item_vec) / (pred @ item_vec +
+                                             lambda_ * user_vec + eps)
+    pred = masked_product(m, user_vec, item_vec)
+    item_vec = item_vec * (m.T @ user_vec) / (pred.T @ user_vec +
+                                               lambda_ * item_vec + eps)
+    return user_vec, item_vec
+
+
+def is_converged(deltas, tol=1e-4):
+    """所有参数矩阵一轮内的平均绝对变化量都小于tol时认为已收敛
+    """
+    return all(np.mean(np.abs(delta)) < tol for delta in deltas)
+
+
+# ALS每个子任务中(用户数 * 观测数 * latent_dim)的上限, 限制批量求解时的临时内存
+ALS_TASK_ELEMENTS = 1 << 22
+
+
+def als_tasks(major, minor, rates, n_major, latent_dim):
+    """将ALS中各行(用户或项目)的最小二乘问题按观测数分组
+
+    观测数相同的行可以把特征堆叠成(g, c, latent_dim)的数组, 用一次批量的np.linalg.solve求解
+
+    Args:
+        major : 需要求解的一侧的id(例如更新用户时为uid)
+        minor : 固定的一侧的id
+        rates : 评分
+        n_major : 需要求解的一侧的总数
+        latent_dim : 隐特征维度
+
+    Returns:
+        list: [(rows, cols, vals)], rows为(g,), cols和vals为(g, c)
+    """
+    order = np.argsort(major, kind="stable")
+    minor, rates = minor[order], rates[order]
+    counts = np.bincount(major, minlength=n_major)
+    indptr = np.concatenate(([0], np.cumsum(counts)))
+
+    tasks = []
+    rows_by_count = np.argsort(counts, kind="stable")
+    sorted_counts = counts[rows_by_count]
+    bounds = np.flatnonzero(np.diff(sorted_counts)) + 1
+    for group in np.split(rows_by_count, bounds):
+        c = counts[group[0]]
+        if c == 0:
+            continue  # 没有观测的行保持不变
+        step = max(ALS_TASK_ELEMENTS // (c * latent_dim), 1)
+        for start in range(0, len(group), step):
+            rows = group[start:start + step]
+            idx = indptr[rows][:, None] + np.arange(c)
+            tasks.append((rows, minor[idx], rates[idx]))
+    return tasks
+
+
+def als_solve(fixed, cols, vals, lambda_, weighted=True):
+    """批量求解一组观测数相同的行的岭回归
+
+    Args:
+        fixed : 固定一侧的特征矩阵
+        cols : (g, c)的观测下标
+        vals : (g, c)的观测值
+        lambda_ : 正则化系数
+        weighted : 正则项是否按观测数加权(lambda * n), False时为PMF的MAP估计. Defaults to True.
+
+    Returns:
+        np.ndarray: (g, latent_dim)的最优解
+    """
+    f = fixed[cols]  # (g, c, d)
+    c, d = cols.shape[1], fixed.shape[1]
+    reg = lambda_ * c if weighted else lambda_
+    a = np.einsum("gcd,gce->gde", f, f) + reg * np.eye(d)
+    b = np.einsum("gcd,gc->gd", f, vals)
+    return np.linalg.solve(a, b[..., None])[..., 0]
+
+
+def fold_in(fixed, ids, rates, lambda_, weighted=True):
+    """固定对侧的特征矩阵, 用新用户(或新服务)的少量观测求解其特征向量
+
+    与ALS中单行的更新相同, 是一个latent_dim维的岭回归, 不需要重新训练
+
+    Args:
+        fixed : 对侧的特征矩阵(新用户时为项目特征矩阵)
+        ids : 观测到的对侧id
+        rates : 观测值
+        lambda_ : 正则化系数
+        weighted : 正则项是否按观测数加权, 与als_solve相同. Defaults to True.
+
+    Returns:
+        np.ndarray: (latent_dim,)的特征向量, 没有观测时为零向量
+    """
+    ids = np.asarray(ids, dtype=np.int64)
+    rates = np.asarray(rates, dtype=np.float64)
+    assert ids.shape == rates.shape and ids.ndim == 1
+    if len(ids) == 0:
+        return np.zeros(fixed.shape[1])
+    return als_solve(fixed, ids[None], rates[None], lambda_, weighted)[0]
+
+
+# 子进程中的ALS状态: 共享内存中的特征矩阵和各组的观测数据
+_als_worker_state = {}
+
+
+def _init_als_worker(specs, tasks, lambdas, weighted):
+    _als_worker_state["vecs"] = {
+        side: SharedArray.attach(spec)
+        for side, spec in specs.items()
+    }
+    _als_worker_state["tasks"] = tasks
+    _als_worker_state["lambdas"] = lambdas
+    _als_worker_state["weighted"] = weighted
+
+
+def _als_worker(job):
+    side, k = job
+    fixed = _als_worker_state["vecs"]["item" if side == "user" else "user"]
+    _, cols, vals = _als_worker_state["tasks"][side][k]
+    return k, als_solve(fixed.array, cols, vals,
+                        _als_worker_state["lambdas"][side],
+                        _als_worker_state["weighted"])
+
+
+class ALSSolver(object):
+    """交替最小二乘求解器
+
+    每一轮先固定项目特征求解所有用户的岭回归, 再固定用户特征求解所有项目的岭回归.
+    观测数相同的用户/项目批量求解, n_jobs > 1时各组分配给多个进程,
+    特征矩阵放在共享内存中, 观测数据只在创建进程池时传递一次.
+
+    Args:
+        uids, iids, rates : 训练数据的三列
+        n_user, n_item : 用户数和项目数
+        latent_dim : 隐特征维度
+        lambda_ : 用户特征的正则化系数(lambda_item为None时也用于项目特征)
+        n_jobs : 进程数, -1表示使用所有CPU核心. Defaults to 1.
+        lambda_item : 项目特征的正则化系数, None表示与lambda_相同. Defaults to None.
+        weighted : 正则项是否按观测数加权. Defaults to True.
+    """
+    def __init__(self,
+                 uids,
+                 iids,
+                 rates,
+                 n_user,
+                 n_item,
+                 latent_dim,
+                 lambda_,
+                 n_jobs=1,
+                 lambda_item=None,
+                 weighted=True) -> None:
+        self.lambdas = {
+            "user": lambda_,
+            "item": lambda_ if lambda_item is None else lambda_item
+        }
+        self.weighted = weighted
+        self.tasks = {
+            "user": als_tasks(uids, iids, rates, n_user, latent_dim),
+            "item": als_tasks(iids, uids, rates, n_item, latent_dim)
+        }
+        self.n_jobs = get_n_jobs(n_jobs)
+        self._pool = None
+        self._shared = None
+        if self.n_jobs > 1:
+            self._shared = {
+                "user": SharedArray.empty((n_user, latent_dim)),
+                "item": SharedArray.empty((n_item, latent_dim))
+            }
+            specs = {side: a.spec for side, a in self._shared.items()}
+            self._pool = Pool(self.n_jobs,
+                              initializer=_init_als_worker,
+                              initargs=(specs, self.tasks, self.lambdas,
+                                        weighted))
+
+    def _solve(self, side, vecs):
+        """更新一侧的特征矩阵, 返回参数的变化量
+        """
+        target = vecs[side]
+        fixed_side = "item" if side == "user" else "user"
+        delta = np.zeros_like(target)
+        tasks = self.tasks[side]
+        if self._pool is None:
+            solutions = ((k,
+                          als_solve(vecs[fixed_side], cols, vals,
+                                    self.lambdas[side], self.weighted))
+                         for k, (_, cols, vals) in enumerate(tasks))
+        else:
+            self._shared[fixed_side].array[...] = vecs[fixed_side]
+            jobs = [(side, k) for k in range(len(tasks))]
+            solutions = self._pool.imap_unordered(_als_worker, jobs)
+        for k, solution in solutions:
+            rows = tasks[k][0]
+            delta[rows] = solution - target[rows]
+            target[rows] = solution
+        return delta
+
+    def sweep(self, user_vec, item_vec):
+        """交替更新一轮用户特征和项目特征(原地更新)
+
+        Returns:
+            (用户特征的变化量, 项目特征的变化量)
+        """
+        vecs = {"user": user_vec, "item": item_vec}
+        user_delta = self._solve("user", vecs)
+        item_delta = self._solve("item", vecs)
+        return user_delta, item_delta
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        if self._shared is not None:
+            for array in self._shared.values():
+                array.close()
+            self._shared = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# Hogwild训练可以使用的每轮训练函数
+SGD_KERNELS = {"sgd": sgd_epoch, "nmf": nmf_sgd_epoch}
+
+# 子进程中的Hogwild状态: 共享内存中的特征矩阵、训练数据和本轮的打乱顺序
+_hogwild_state = {}
+
+
+def _init_hogwild_worker(specs, kernel, kwargs):
+    _hogwild_state["arrays"] = {
+        key: SharedArray.attach(spec)
+        for key, spec in specs.items()
+    }
+    _hogwild_state["kernel"] = SGD_KERNELS[kernel]
+    _hogwild_state["kwargs"] = kwargs
+
+
+def _hogwild_worker(bounds):
+    start, end = bounds
+    arrays = {key: a.array for key, a in _hogwild_state["arrays"].items()}
+    idx = arrays["order"][start:end]
+    user_delta = np.zeros_like(arrays["user"])
+    item_delta = np.zeros_like(arrays["item"])
+    # 不加锁, 直接更新共享内存中的特征矩阵
+    _hogwild_state["kernel"](arrays["user"],
+                             arrays["item"],
+                             arrays["uids"][idx],
+                             arrays["iids"][idx],
+                             arrays["rates"][idx],
+                             user_delta=user_delta,
+                             item_delta=item_delta,
+                             **_hogwild_state["kwargs"])
+    return user_delta, item_delta
+
+
+class HogwildSGD(object):
+    """Hogwild式的无锁并行SGD
+
+    用户和项目特征矩阵放在共享内存(内存映射)中, 每一轮将训练数据打乱后切成n_jobs份互不相交的分片,
+    各进程在自己的分片上不加锁地更新共享的特征矩阵. 评分矩阵很稀疏, 不同进程同时更新同一行的概率很小.
+
+    seed固定时每一轮的打乱和分片是确定的; 由于进程间的更新顺序不确定, 多进程的结果只是近似可复现,
+    n_jobs=1时结果完全可复现.
+
+    Args:
+        user_vec, item_vec : 特征矩阵, 每一轮结束后同步为训练后的值
+        uids, iids, rates : 训练数据的三列
+        kernel : 每个分片使用的训练函数, 可选参数: sgd, nmf
+        n_jobs : 进程数, -1表示使用所有CPU核心
+        seed : 打乱训练数据的随机种子, None表示使用np.random的全局状态
+        kwargs : 传给训练函数的参数, 例如lr, lambda_, batch_size
+    """
+    def __init__(self,
+                 user_vec,
+                 item_vec,
+                 uids,
+                 iids,
+                 rates,
+                 kernel="sgd",
+                 n_jobs=-1,
+                 seed=None,
+                 **kwargs) -> None:
+        assert kernel in SGD_KERNELS, f"unknown kernel: {kernel}"
+        self.user_vec = user_vec
+        self.item_vec = item_vec
+        self.n_jobs = get_n_jobs(n_jobs)
+        self.rng = np.random.default_rng(seed) if seed is not None else None
+        self._shared = {
+            "user": SharedArray.copy_from(user_vec),
+            "item": SharedArray.copy_from(item_vec),
+            "uids": SharedArray.copy_from(uids),
+            "iids": SharedArray.copy_from(iids),
+            "rates": SharedArray.copy_from(rates),
+            "order": SharedArray.empty((len(rates), ), np.int64)
+        }
+        specs = {key: a.spec for key, a in self._shared.items()}
+        self._pool = Pool(self.n_jobs,
+                          initializer=_init_hogwild_worker,
+                          initargs=(specs, kernel, kwargs))
+
+    def epoch(self):
+        """训练一轮
+
+        Returns:
+            (用户特征的变化量, 项目特征的变化量)
+        """
+        n = len(self._shared["order"].array)
+        if self.rng is None:
+            order = np.random.permutation(n)
+        else:
+            order = self.rng.permutation(n)
+        self._shared["order"].array[...] = order
+        bounds = np.linspace(0, n, self.n_jobs + 1).astype(np.int64)
+        shards = list(zip(bounds[:-1], bounds[1:]))
+
+        user_delta = np.zeros_like(self.user_vec)
+        item_delta = np.zeros_like(self.item_vec)
+        for u_delta, i_delta in self._pool.imap_unordered(
+                _hogwild_worker, shards):
+            user_delta += u_delta
+            item_delta += i_delta
+        self.user_vec[...] = self._shared["user"].array
+        self.item_vec[...] = self._shared["item"].array
+        return user_delta, item_delta
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+            for array in self._shared.values():
+                array.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# 批量打分时每一块的三元组数量
+SCORE_CHUNK_SIZE = 1 << 16
+
+
+class FactorScorer(object):
+    """用户/项目特征矩阵的批量打分: y_pred[k] = U[uids[k]] @ V[iids[k]]
+
+    按固定大小分块计算, 每块先把用到的特征行取到float32的缓冲区中再做einsum,
+    缓冲区在各块之间复用. 特征矩阵可以是np.memmap, 此时只会读取用到的行.
+
+    Args:
+        user_vec : 用户特征矩阵 (n_user, latent_dim)
+        item_vec : 项目特征矩阵 (n_item, latent_dim)
+        chunk_size : 每一块的三元组数量. Defaults to SCORE_CHUNK_SIZE.
+        dtype : 缓冲区和计算使用的类型. Defaults to np.float32.
+    """
+    def __init__(self,
+                 user_vec,
+                 item_vec,
+                 chunk_size=SCORE_CHUNK_SIZE,
+                 dtype=np.float32) -> None:
+        assert user_vec.shape[1] == item_vec.shape[1], "latent_dim mismatch"
+        assert chunk_size > 0
+        self.user_vec = user_vec
+        self.item_vec = item_vec
+        self.chunk_size = chunk_size
+        self.dtype = np.dtype(dtype)
+
+    @classmethod
+    def from_npy(cls, user_vec_path, item_vec_path, **kwargs):
+        """以内存映射的方式读取保存的*_users_vec.npy / *_items_vec.npy
+        """
+        return cls(np.load(user_vec_path, mmap_mode="r"),
+                   np.load(item_vec_path, mmap_mode="r"), **kwargs)
+
+    def score(self, uids, iids):
+        """计算每一对(uid, iid)的预测值
+
+        Returns:
+            np.ndarray: float64的预测值, 长度与uids相同
+        """
+        uids = np.asarray(uids, dtype=np.int64)
+        iids = np.asarray(iids, dtype=np.int64)
+        assert uids.shape == iids.shape
+        y_pred = np.empty(len(uids))
+        chunk = max(min(self.chunk_size, len(uids)), 1)
+        latent_dim = self.user_vec.shape[1]
+        user_buf = np.empty((chunk, latent_dim), dtype=self.dtype)
+        item_buf = np.empty((chunk, latent_dim), dtype=self.dtype)
+        score_buf = np.empty(chunk, dtype=self.dtype)
+        for start in range(0, len(uids), chunk):
+            end = min(start + chunk, len(uids))
+            n = end - start
+            user_buf[:n] = self.user_vec[uids[start:end]]
+            item_buf[:n] = self.item_vec[iids[start:end]]
+            np.einsum("ij,ij->i", user_buf[:n], item_buf[:n],
+                      out=score_buf[:n])
+            y_pred[start:end] = score_buf[:n]
+        return y_pred
+
+    def predict(self, triad):
+        """对三元组打分
+
+        Returns:
+            (真实值, 预测值), 均为np.ndarray
+        """
+        uids, iids, rates = split_triad(triad)
+        return rates, self.score(uids, iids)
+
+    def top_n(self,
+              uids,
+              k=10,
+              exclude=None,
+              candidates=None,
+              largest=False):
+        """为每个用户从所有(或候选)服务中选出预测值最小(或最大)的k个服务
+
+        每个用户对所有候选服务的打分用一次矩阵乘法计算, 再用np.argpartition选出前k个
+
+        Args:
+            uids : 用户id
+            k : 推荐的服务数量. Defaults to 10.
+            exclude : 需要排除的(uid, iid, ...)三元组, 例如训练数据(用户已经调用过的服务). Defaults to None.
+            candidates : 候选服务的id, None表示所有服务. Defaults to None.
+            largest : True时选预测值最大的服务(例如tp), False时选最小的(例如rt). Defaults to False.
+
+        Returns:
+            (iids, scores): 均为(len(uids), k), 按预测值排序, 可推荐的服务不足k个时iid补-1, 预测值补nan
+        """
+        uids = np.asarray(uids, dtype=np.int64)
+        n_item = len(self.item_vec)
+        if candidates is None:
+            candidates = np.arange(n_item)
+        candidates = np.asarray(candidates, dtype=np.int64)
+        assert k > 0 and len(candidates) > 0
+        k_ = min(k, len(candidates))
+        # 升序选择, largest时对预测值取负
+        sign = -1 if largest else 1
+        items = sign * np.asarray(self.item_vec[candidates], dtype=self.dtype)
+
+        if exclude is not None and len(exclude) == 0:
+            exclude = None
+        if exclude is not None:
+            exclude = np.asarray(exclude)
+            ex_uids = exclude[:, 0].astype(np.int64)
+            ex_iids = exclude[:, 1].astype(np.int64)
+            # 超出项目特征矩阵范围的服务不会被推荐, 不需要排除
+            in_range = ex_iids < n_item
+            ex_uids, ex_iids = ex_uids[in_range], ex_iids[in_range]
+            n_user = max(len(self.user_vec), int(ex_uids.max(initial=-1)) + 1)
+            exclude = csr_matrix(
+                (np.ones(len(ex_uids), dtype=bool), (ex_uids, ex_iids)),
+                shape=(n_user, n_item))
+            # 只保留候选服务对应的列
+            exclude = exclude[:, candidates].tocsr()
+
+        iids = np.full((len(uids), k), -1, dtype=np.int64)
+        scores = np.full((len(uids), k), np.nan)
+        rows_per_chunk = max(min(self.chunk_size // len(candidates), len(uids)),
+                             1)
+        user_buf = np.empty((rows_per_chunk, items.shape[1]), dtype=self.dtype)
+        score_buf = np.empty((rows_per_chunk, len(candidates)),
+                             dtype=self.dtype)
+        for start in range(0, len(uids), rows_per_chunk):
+            end = min(start + rows_per_chunk, len(uids))
+            n = end - start
+            user_buf[:n] = self.user_vec[uids[start:end]]
+            block = np.matmul(user_buf[:n], items.T, out=score_buf[:n])
+            if exclude is not None:
+                sub = exclude[uids[start:end]]
+                block[np.repeat(np.arange(n), np.diff(sub.indptr)),
+                      sub.indices] = np.inf
+            if k_ < len(candidates):
+                top = np.argpartition(block, k_ - 1, axis=1)[:, :k_]
+                top.sort(axis=1)  # 预测值相同时按服务id排序
+            else:
+                top = np.broadcast_to(np.arange(len(candidates)), (n, k_))
+            top_scores = np.take_along_axis(block, top, axis=1)
+            order = np.argsort(top_scores, axis=1, kind="stable")
+            top = np.take_along_axis(top, order, axis=1)
+            top_scores = np.take_along_axis(top_scores, order, axis=1)
+            valid = np.isfinite(top_scores)
+            iids[start:end, :k_] = np.where(valid, candidates[top], -1)
+            scores[start:end, :k_] = np.where(valid, sign * top_scores, np.nan)
+        return iids, scores
@@ -2,10 +2,12 @@ import copy
 import os
 import random
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import torch
 from root import absolute
+from scipy.sparse import csr_matrix
 from torch import nn
 """
     Some handy functions for model training ...
@@ -40,6 +42,110 @@ def load_checkpoint(file_path: str, device=None):
     return ckpt
 
 
+def snapshot_state(state):
+    """复制一份与训练过程无关的状态, 张量拷贝到CPU, 之后训练对参数的修改不会影响快照
+    """
+    if isinstance(state, torch.Tensor):
+        return state.detach().to("cpu", copy=True)
+    if isinstance(state, dict):
+        return type(state)(
+            (k, snapshot_state(v)) for k, v in state.items())
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot_state(v) for v in state)
+    return copy.deepcopy(state)
+
+
+class CheckpointManager(object):
+    """只保留loss最小的K个checkpoint
+
+    每个checkpoint是参数的快照(snapshot_state), 在后台线程中写入文件,
+    被挤出前K名的checkpoint的文件也在后台线程中删除. 写入和删除由同一个线程按提交顺序执行.
+    内存中只保留loss最小的快照, 其余的快照写入文件后释放.
+
+    Args:
+        save_dirname : 保存的目录(相对于项目根目录)
+        keep : 保留的checkpoint数量. Defaults to 3.
+        async_save : 是否在后台线程中写文件. Defaults to True.
+    """
+    def __init__(self, save_dirname, keep=3, async_save=True) -> None:
+        assert keep > 0
+        self.save_dir = absolute(save_dirname)
+        self.keep = keep
+        self.checkpoints = []  # [(loss, 文件路径)], 按loss升序
+        self.async_save = async_save
+        self._best = None  # loss最小的快照
+        self._executor = None  # 第一次保存时创建, close之后再保存时重新创建
+        self._pending = []
+
+    def save(self, state, loss, filename):
+        """loss进入前K名时保存checkpoint
+
+        Returns:
+            bool: 是否保存
+        """
+        if len(self.checkpoints) >= self.keep and \
+                loss >= self.checkpoints[-1][0]:
+            print("=> Validation Accuracy did not improve")
+            return False
+        snapshot = snapshot_state(state)
+        file_path = os.path.join(self.save_dir, filename)
+        self.checkpoints.append((loss, file_path))
+        self.checkpoints.sort(key=lambda x: x[0])
+        evicted = [path for _, path in self.checkpoints[self.keep:]]
+        del self.checkpoints[self.keep:]
+        if self.checkpoints[0][1] == file_path:
+            self._best = snapshot
+        print(f"=> Saving checkpoint {file_path}")
+        self._submit(self._write, snapshot, file_path, evicted)
+        return True
+
+    def _write(self, snapshot, file_path, evicted):
+        os.makedirs(self.save_dir, exist_ok=True)
+        torch.save(snapshot, file_path)
+        for path in evicted:
+            if path != file_path and os.path.isfile(path):
+                os.remove(path)
+
+    def _submit(self, fn, *args):
+        if not self.async_save:
+            fn(*args)
+        else:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=1)
+            # 出错的写入保留到wait中抛出异常
+            self._pending = [
+                f for f in self._pending
+                if not f.done() or f.exception() is not None
+            ]
+            self._pending.append(self._executor.submit(fn, *args))
+
+    def best(self):
+        """loss最小的checkpoint快照, 没有checkpoint时返回None
+        """
+        return self._best
+
+    @property
+    def best_path(self):
+        if not self.checkpoints:
+            return None
+        return self.checkpoints[0][1]
+
+    def wait(self):
+        """等待后台的写入和删除完成, 写入出错时在这里抛出异常
+        """
+        pending, self._pending = self._pending, []
+        for future in pending:
+            future.result()
+
+    def close(self):
+        try:
+            self.wait()
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+
 def use_cuda(enabled, device_id=0):
     if enabled:
         assert torch.cuda.is_available(), 'CUDA is not available'
@@ -53,17 +159,136 @@ def freeze_random(seed=2021):
     np.random.seed(seed)
 
 
-def triad_to_matrix(triad, nan_symbol=-1):
+class SparseQoSMatrix(object):
+    """稀疏QoS矩阵
+
+    只保存观测到的QoS值, 同时维护CSR(按用户访问)和CSC(按服务访问)两种存储.
+    读取缺失项时返回nan_symbol, 与triad_to_matrix得到的稠密矩阵语义一致.
+    """
+    def __init__(self, uids, iids, rates, shape=None, nan_symbol=-1):
+        uids = np.asarray(uids).astype(np.int64)
+        iids = np.asarray(iids).astype(np.int64)
+        rates = np.asarray(rates)
+        if shape is None:
+            shape = (int(uids.max()) + 1, int(iids.max()) + 1)
+        self.nan_symbol = nan_symbol
+
+        # 重复的(uid, iid)以最后一次出现的为准(与稠密矩阵赋值的结果一致), 并按行优先排序
+        keys = uids * shape[1] + iids
+        _, last = np.unique(keys[::-1], return_index=True)
+        keep = len(keys) - 1 - last
+        self.csr = csr_matrix((rates[keep], (uids[keep], iids[keep])),
+                              shape=shape)
+        self.csr.sort_indices()
+        self.csc = self.csr.tocsc()
+        self.csc.sort_indices()
+        self._keys = keys[keep]  # 每个观测值在行优先展开后的位置, 用于向量化查询
+
+    @property
+    def shape(self):
+        return self.csr.shape
+
+    @property
+    def nnz(self):
+        return self.csr.nnz
+
+    @property
+    def dtype(self):
+        return self.csr.dtype
+
+    def user_row(self, uid):
+        """返回用户uid调用过的服务及对应的QoS值: (iids, rates)
+        """
+        start, end = self.csr.indptr[uid], self.csr.indptr[uid + 1]
+        return self.csr.indices[start:end], self.csr.data[start:end]
+
+    def item_col(self, iid):
+        """返回调用过服务iid的用户及对应的QoS值: (uids, rates)
+        """
+        start, end = self.csc.indptr[iid], self.csc.indptr[iid + 1]
+        return self.csc.indices[start:end], self.csc.data[start:end]
+
+    def dense_row(self, uid, fill=0):
+        """用户uid对应的稠密行向量, 缺失项用fill填充
+        """
+        row = np.full(self.shape[1], fill, dtype=self.dtype)
+        iids, rates = self.user_row(uid)
+        row[iids] = rates
+        return row
+
+    def dense_col(self, iid, fill=0):
+        """服务iid对应的稠密列向量, 缺失项用fill填充
+        """
+        col = np.full(self.shape[0], fill, dtype=self.dtype)
+        uids, rates = self.item_col(iid)
+        col[uids] = rates
+        return col
+
+    def get(self, uid, iid):
+        """查询QoS值, 支持标量和数组(可广播), 缺失项或越界返回nan_symbol
+        """
+        uid, iid = np.asarray(uid), np.asarray(iid)
+        if self.nnz == 0:
+            res = np.full(np.broadcast(uid, iid).shape, self.nan_symbol,
+                          dtype=self.csr.dtype)
+            return res.item() if res.ndim == 0 else res
+        m, n = self.shape
+        in_range = (uid >= 0) & (uid < m) & (iid >= 0) & (iid < n)
+        query = uid.astype(np.int64) * n + iid
+        pos = np.minimum(np.searchsorted(self._keys, query),
+                         max(len(self._keys) - 1, 0))
+        found = in_range & (self._keys[pos] == query)
+        res = np.where(found, self.csr.data[pos], self.nan_symbol)
+        return res.item() if res.ndim == 0 else res
+
+    def user_mean(self):
+        """每个用户非0 QoS值的均值, 没有调用记录的用户为0
+        """
+        return self._nonzero_mean(self.csr)
+
+    def item_mean(self):
+        """每个服务非0 QoS值的均值, 没有调用记录的服务为0
+        """
+        return self._nonzero_mean(self.csc)
+
+    @staticmethod
+    def _nonzero_mean(m):
+        lengths = np.diff(m.indptr)
+        major = np.repeat(np.arange(len(lengths)), lengths)
+        n_major = len(lengths)
+        total = np.bincount(major, weights=m.data, minlength=n_major)
+        cnt = np.bincount(major, weights=m.data != 0, minlength=n_major)
+        res = np.zeros(n_major)
+        np.divide(total, cnt, out=res, where=cnt != 0)
+        return res
+
+    def to_dense(self):
+        """转成用nan_symbol填充缺失项的稠密矩阵
+        """
+        matrix = np.full(self.shape, self.nan_symbol, dtype=self.dtype)
+        coo = self.csr.tocoo()
+        matrix[coo.row, coo.col] = coo.data
+        return matrix
+
+    def __repr__(self) -> str:
+        return f"SparseQoSMatrix(shape={self.shape}, nnz={self.nnz})"
+
+
+def triad_to_matrix(triad, nan_symbol=-1, sparse=False):
     """三元组转矩阵
 
     Args:
         triad : 三元组
         nan_symbol : 非零数据的表示方法. Defaults to -1.
+        sparse : 是否返回稀疏矩阵SparseQoSMatrix. Defaults to False.
 
     """
     # 注意下标应该为int
     if not isinstance(triad, np.ndarray):
         triad = np.array(triad)
+    if sparse:
+        return SparseQoSMatrix(triad[:, 0], triad[:, 1], triad[:, 2],
+                               nan_symbol=nan_symbol)
     x_max = triad[:, 0].max().astype(int)  # 用户数量
     y_max = triad[:, 1].max().astype(int)  # 项目数量
     matrix = np.full((x_max + 1, y_max + 1), nan_symbol,
@@ -81,6 +306,8 @@ def split_d_triad(d_triad):
 def nonzero_user_mean(matrix, nan_symbol):
     """快速计算一个矩阵的行均值
     """
+    if isinstance(matrix, SparseQoSMatrix):
+        return matrix.user_mean()
     m = copy.deepcopy(matrix)
     m[matrix == nan_symbol] = 0
     t = (m != 0).sum(axis=-1)  # 每行非0元素的个数
@@ -92,6 +319,8 @@ def nonzero_user_mean(matrix, nan_symbol):
 def nonzero_item_mean(matrix, nan_symbol):
     """快速计算一个矩阵的列均值
     """
+    if isinstance(matrix, SparseQoSMatrix):
+        return matrix.item_mean()
     return nonzero_user_mean(matrix.T, nan_symbol)
 
 
@@ -0,0 +1,75 @@
+import os
+from multiprocessing import shared_memory
+
+import numpy as np
+"""
+    Helpers for sharing numpy arrays between worker processes
+"""
+
+
+def get_n_jobs(n_jobs):
+    """将n_jobs转换为实际的进程数, -1表示使用所有CPU核心
+    """
+    if n_jobs is None:
+        return 1
+    if n_jobs < 0:
+        return max(os.cpu_count() + 1 + n_jobs, 1)
+    assert n_jobs > 0
+    return n_jobs
+
+
+class SharedArray(object):
+    """放在共享内存中的numpy数组
+
+    主进程用SharedArray.copy_from(array)创建, 把spec传给子进程,
+    子进程用SharedArray.attach(spec)得到同一块内存上的数组, 不需要序列化数组本身
+
+    Args:
+        shm : SharedMemory对象
+        shape : 数组形状
+        dtype : 数组类型
+        owner : 是否由当前进程创建(负责释放)
+    """
+    def __init__(self, shm, shape, dtype, owner=False) -> None:
+        self.shm = shm
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.owner = owner
+        self.array = np.ndarray(self.shape, dtype=self.dtype, buffer=shm.buf)
+
+    @classmethod
+    def empty(cls, shape, dtype=np.float64):
+        nbytes = max(int(np.prod(shape)) * np.dtype(dtype).itemsize, 1)
+        shm = shared_memory.SharedMemory(create=True, size=nbytes)
+        return cls(shm, shape, dtype, owner=True)
+
+    @classmethod
+    def copy_from(cls, array):
+        array = np.ascontiguousarray(array)
+        shared = cls.empty(array.shape, array.dtype)
+        shared.array[...] = array
+        return shared
+
+    @property
+    def spec(self):
+        """子进程attach时需要的信息
+        """
+        return self.shm.name, self.shape, self.dtype.str
+
+    @classmethod
+    def attach(cls, spec):
+        name, shape, dtype = spec
+        shm = shared_memory.SharedMemory(name=name)
+        return cls(shm, shape, dtype)
+
+    def close(self):
+        self.array = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,469 @@
+import os
+from multiprocessing import Pool
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.stats import pearsonr
+from tqdm import tqdm
+from utils import logger
+from utils.parallel import SharedArray, get_n_jobs
+"""
+    Vectorized similarity computation for memory-based models ...
+"""
+
+# 方差相对于平方和小于该阈值时认为数值不稳定, 改用逐对的精确计算
+_DEGENERATE_RTOL = 1e-6
+# 计算一块相似度时, 每一行大约需要的(n_rows长的float64)临时数组个数
+_BLOCK_TEMPORARIES = 12
+DEFAULT_MEMORY_BUDGET = 512 * 2**20  # 分块计算时默认的内存预算(字节)
+
+
+def _nonzero_csr(m):
+    """拷贝一份CSR矩阵并去掉值为0的元素(与稠密矩阵用np.nonzero取交集的语义一致)
+    """
+    m = csr_matrix(m, dtype=np.float64, copy=True)
+    m.eliminate_zeros()
+    m.sort_indices()
+    return m
+
+
+def _pair_pcc(m, i, j, enhanced=False):
+    """逐对计算第i行和第j行在共同非零位置上的皮尔逊相关系数
+
+    与原来的实现保持一致: 交集为空或任意一方在交集上的值全部相等时相似度为0
+    """
+    row_i, row_j = slice(*m.indptr[i:i + 2]), slice(*m.indptr[j:j + 2])
+    idx_i, x = m.indices[row_i], m.data[row_i]
+    idx_j, y = m.indices[row_j], m.data[row_j]
+    intersect, a, b = np.intersect1d(idx_i,
+                                     idx_j,
+                                     assume_unique=True,
+                                     return_indices=True)
+    if len(intersect) == 0 or len(set(x[a])) == 1 or len(set(y[b])) == 1:
+        return 0
+    try:
+        sim = pearsonr(x[a], y[b])[0]
+    except Exception:
+        return 0
+    if enhanced:
+        sim = (2 * len(intersect) / (len(idx_i) + len(idx_j))) * sim  # 增强PCC
+    return sim
+
+
+class PCCOperands(object):
+    """PCC计算所需的稀疏矩阵
+
+    每行先减去该行的均值(PCC对整行平移不变, 中心化可以减少数值误差), 再准备好
+    掩码矩阵和平方矩阵, 之后任意一块行与所有行之间的统计量都可以用稀疏矩阵乘法得到
+    """
+    def __init__(self, m) -> None:
+        m = _nonzero_csr(m)
+        n_rows = m.shape[0]
+        lengths = np.diff(m.indptr)
+        row_sum = np.bincount(np.repeat(np.arange(n_rows), lengths),
+                              weights=m.data,
+                              minlength=n_rows)
+        row_mean = np.divide(row_sum,
+                             lengths,
+                             out=np.zeros(n_rows),
+                             where=lengths != 0)
+        centered = m.data - np.repeat(row_mean, lengths)
+        self._setup(m.shape, m.data, m.indices, m.indptr, centered)
+
+    @classmethod
+    def from_arrays(cls, shape, data, indices, indptr, centered):
+        """用CSR的各个数组直接构造(不拷贝), 用于子进程从共享内存中恢复
+        """
+        ops = cls.__new__(cls)
+        ops._setup(shape, data, indices, indptr, centered)
+        return ops
+
+    def _setup(self, shape, data, indices, indptr, centered):
+        structure = (indices, indptr)
+        self.m = csr_matrix((data, *structure), shape=shape, copy=False)
+        self.counts = np.diff(indptr)  # 每行的非零元素个数
+        self.centered = centered
+        self.values = csr_matrix((centered, *structure),
+                                 shape=shape,
+                                 copy=False)
+        self.squares = csr_matrix((centered**2, *structure), shape=shape)
+        self.mask = csr_matrix((np.ones_like(centered), *structure),
+                               shape=shape)
+
+    @property
+    def shape(self):
+        return self.m.shape
+
+
+def pcc_block(ops: PCCOperands, start, end, enhanced=False):
+    """计算第[start, end)行与所有行之间的皮尔逊相关系数
+
+    用掩码矩阵乘法一次得到每一对行的共同评分个数、共同位置上的和、平方和与交叉积,
+    结果与逐对调用pearsonr一致(包括交集为空、方差为0时相似度为0的规则)
+
+    Returns:
+        np.ndarray: (end - start, n_rows)
+    """
+    block_values = ops.values[start:end].toarray()
+    block_mask = ops.mask[start:end].toarray()
+
+    # 稀疏矩阵 @ 稠密矩阵, 结果的第k列对应块内第k行
+    n = (ops.mask @ block_mask.T).T  # 共同评分个数
+    sx = (ops.mask @ block_values.T).T  # 块内行在交集上的和
+    sy = (ops.values @ block_mask.T).T  # 其余行在交集上的和
+    sxx = (ops.mask @ (block_values**2).T).T
+    syy = (ops.squares @ block_mask.T).T
+    sxy = (ops.values @ block_values.T).T
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        var_x = sxx - sx * sx / n
+        var_y = syy - sy * sy / n
+        cov = sxy - sx * sy / n
+        sim = cov / np.sqrt(var_x * var_y)
+        np.clip(sim, -1, 1, out=sim)
+        # 交集只有两个元素时pearsonr的结果恰好为±1, 这里同样取精确值, 避免排序时打破并列的顺序
+        pair = n == 2
+        sim[pair] = np.sign(cov[pair])
+        if enhanced:
+            counts = ops.counts
+            sim *= 2 * n / (counts[start:end, None] + counts[None, :])
+
+    # 交集少于两个元素时值必然全部相等, 相似度为0
+    sim[n < 2] = 0
+    # 方差接近0时公式中的相减会损失精度, 这些(极少的)行对用原来的方法逐对计算
+    degenerate = (n >= 2) & ((var_x <= _DEGENERATE_RTOL * sxx) |
+                             (var_y <= _DEGENERATE_RTOL * syy))
+    for i, j in zip(*np.nonzero(degenerate)):
+        sim[i, j] = _pair_pcc(ops.m, start + i, j, enhanced)
+
+    # 与原来的实现一致, 对角线(自身)的相似度为0
+    rows = np.arange(end - start)
+    sim[rows, start + rows] = 0
+    return sim
+
+
+def get_block_size(n_rows, n_cols, memory_budget=None):
+    """根据内存预算计算每次处理的行数
+
+    Args:
+        n_rows : 相似度矩阵的边长
+        n_cols : 每行向量的长度
+        memory_budget : 内存预算(字节). Defaults to DEFAULT_MEMORY_BUDGET.
+    """
+    if memory_budget is None:
+        memory_budget = DEFAULT_MEMORY_BUDGET
+    row_bytes = 8 * (_BLOCK_TEMPORARIES * n_rows + 3 * n_cols)
+    return int(min(max(memory_budget // row_bytes, 1), n_rows))
+
+
+def pcc_similarity(m,
+                   enhanced=False,
+                   block_size=None,
+                   memory_budget=None,
+                   out=None,
+                   n_jobs=1):
+    """计算矩阵所有行两两之间的皮尔逊相关系数
+
+    按行分块计算, 每块只需要O(block_size * n_rows)的临时内存, 结果可以直接写入内存映射文件
+
+    Args:
+        m : 稀疏矩阵(CSR), 只使用其中的非零元素
+        enhanced : 是否使用增强PCC(乘以 2|交集| / (|x| + |y|)). Defaults to False.
+        block_size : 每块的行数, None表示根据memory_budget计算. Defaults to None.
+        memory_budget : 分块计算的内存预算(字节), 不包括结果矩阵, 多进程时为每个进程的预算. Defaults to None.
+        out : 结果的存放位置, 可以是数组或.npy文件路径(以内存映射的方式写入). Defaults to None.
+        n_jobs : 进程数, -1表示使用所有CPU核心. 每一块的结果与分块方式无关, 因此与单进程的结果完全一致. Defaults to 1.
+
+    Returns:
+        np.ndarray | np.memmap: (n_rows, n_rows)的相似度矩阵
+    """
+    ops = PCCOperands(m)
+    n_rows, n_cols = ops.shape
+    if out is None:
+        out = np.zeros((n_rows, n_rows))
+    elif isinstance(out, str):
+        out = np.lib.format.open_memmap(out,
+                                        mode="w+",
+                                        dtype=np.float64,
+                                        shape=(n_rows, n_rows))
+    if block_size is None:
+        block_size = get_block_size(n_rows, n_cols, memory_budget)
+    n_jobs = get_n_jobs(n_jobs)
+
+    blocks = [(start, min(start + block_size, n_rows))
+              for start in range(0, n_rows, block_size)]
+    if n_jobs > 1 and len(blocks) > 1:
+        _parallel_pcc(ops, blocks, enhanced, out, n_jobs)
+    else:
+        if len(blocks) > 1:
+            blocks = tqdm(blocks, desc="生成相似度矩阵")
+        for start, end in blocks:
+            out[start:end] = pcc_block(ops, start, end, enhanced)
+    if isinstance(out, np.memmap):
+        out.flush()
+    return out
+
+
+# 子进程中从共享内存恢复的PCCOperands和结果矩阵
+_worker_state = {}
+
+
+def _init_pcc_worker(shape, specs, out_spec):
+    shared = {key: SharedArray.attach(spec) for key, spec in specs.items()}
+    arrays = {key: array.array for key, array in shared.items()}
+    _worker_state["shared"] = shared  # 保持引用, 避免共享内存被关闭
+    _worker_state["ops"] = PCCOperands.from_arrays(shape, **arrays)
+    _worker_state["out"] = SharedArray.attach(out_spec)
+
+
+def _pcc_worker(task):
+    start, end, enhanced = task
+    out = _worker_state["out"].array
+    out[start:end] = pcc_block(_worker_state["ops"], start, end, enhanced)
+    return start
+
+
+def _parallel_pcc(ops, blocks, enhanced, out, n_jobs):
+    """用进程池计算各块的相似度
+
+    稀疏矩阵的各个数组和结果矩阵都放在共享内存中, 每个任务只传递块的起止行号
+    """
+    arrays = {
+        "data": ops.m.data,
+        "indices": ops.m.indices,
+        "indptr": ops.m.indptr,
+        "centered": ops.centered,
+    }
+    shared = {key: SharedArray.copy_from(a) for key, a in arrays.items()}
+    n_rows = ops.shape[0]
+    result = SharedArray.empty((n_rows, n_rows))
+    try:
+        specs = {key: array.spec for key, array in shared.items()}
+        tasks = [(start, end, enhanced) for start, end in blocks]
+        with Pool(min(n_jobs, len(blocks)),
+                  initializer=_init_pcc_worker,
+                  initargs=(ops.shape, specs, result.spec)) as pool:
+            for _ in tqdm(pool.imap_unordered(_pcc_worker, tasks),
+                          total=len(tasks),
+                          desc="生成相似度矩阵"):
+                pass
+        for start, end in blocks:
+            out[start:end] = result.array[start:end]
+    finally:
+        result.close()
+        for array in shared.values():
+            array.close()
+
+
+DEFAULT_N_NEIGHBORS = 100  # 近邻索引中默认为每一行保存的近邻个数
+DEFAULT_PREDICT_BATCH_SIZE = 4096  # 批量预测时每次同时计算的预测数量
+
+
+class NeighborIndex(object):
+    """近邻索引: 相似度矩阵每一行中相似度最大的前k个近邻及其相似度
+
+    近邻按相似度从大到小排序, 相似度相同时下标小的在前(与稳定排序的结果一致),
+    预测时只需要读取索引中的前topk个近邻, 不用再对整行相似度排序
+
+    Args:
+        similarity_matrix : 相似度矩阵, topk超过索引的大小时用它重新排序
+        indices : (n, k)的近邻下标, 不足k个近邻的位置为-1
+        similarities : (n, k)的近邻相似度
+        counts : 每一行实际的近邻个数
+        positive_only : 是否只保存相似度大于0的近邻
+    """
+    def __init__(self,
+                 similarity_matrix,
+                 indices,
+                 similarities,
+                 counts,
+                 positive_only=False) -> None:
+        self.similarity_matrix = similarity_matrix
+        self.indices = indices
+        self.similarities = similarities
+        self.counts = counts
+        self.positive_only = positive_only
+        self._warned = False  # 重新排序的警告只输出一次
+
+    @property
+    def k(self):
+        return self.indices.shape[1]
+
+    @classmethod
+    def build(cls,
+              similarity_matrix,
+              k=DEFAULT_N_NEIGHBORS,
+              positive_only=False,
+              memory_budget=None):
+        """用argpartition按行分块构建近邻索引
+
+        Args:
+            similarity_matrix : (n, n)的相似度矩阵(可以是内存映射文件)
+            k : 每一行保存的近邻个数. Defaults to DEFAULT_N_NEIGHBORS.
+            positive_only : 是否只保存相似度大于0的近邻. Defaults to False.
+            memory_budget : 分块时的内存预算(字节). Defaults to None.
+        """
+        assert k > 0
+        n = similarity_matrix.shape[0]
+        k = min(k, n)
+        if memory_budget is None:
+            memory_budget = DEFAULT_MEMORY_BUDGET
+        block_size = int(max(memory_budget // (8 * 4 * n), 1))
+
+        indices = np.full((n, k), -1, dtype=np.int32)
+        similarities = np.zeros((n, k), dtype=np.float32)
+        counts = np.zeros(n, dtype=np.int32)
+        for start in range(0, n, block_size):
+            end = min(start + block_size, n)
+            block = np.array(similarity_matrix[start:end], dtype=np.float64)
+            if positive_only:
+                block[~(block > 0)] = -np.inf  # 不满足条件的近邻排在最后
+            idx, sim = _top_k(block, k)
+            valid = sim > -np.inf
+            indices[start:end] = np.where(valid, idx, -1)
+            similarities[start:end] = np.where(valid, sim, 0)
+            counts[start:end] = valid.sum(axis=1)
+        return cls(similarity_matrix, indices, similarities, counts,
+                   positive_only)
+
+    def save(self, dir_path, prefix="neighbors"):
+        """将索引保存为.npy文件, 之后可以用load以内存映射的方式读取
+        """
+        for name in ("indices", "similarities", "counts"):
+            path = os.path.join(dir_path, f"{prefix}.{name}.npy")
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                np.save(f, getattr(self, name))
+            os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls,
+             similarity_matrix,
+             dir_path,
+             prefix="neighbors",
+             positive_only=False):
+        """以内存映射的方式读取save保存的索引, 文件不完整时返回None
+        """
+        arrays = []
+        for name in ("indices", "similarities", "counts"):
+            path = os.path.join(dir_path, f"{prefix}.{name}.npy")
+            if not os.path.isfile(path):
+                return None
+            arrays.append(np.load(path, mmap_mode="r"))
+        return cls(similarity_matrix, *arrays, positive_only=positive_only)
+
+    def neighbors(self, id, topk=-1):
+        """获取前topk个近邻
+
+        Args:
+            id : 当前用户/项目
+            topk : 近邻数量, -1表示不限制数量
+
+        Returns:
+            (近邻下标, 近邻相似度), 依照相似度从大到小排序
+        """
+        assert isinstance(topk, int)
+        assert topk == -1 or topk > 0
+        count = self.counts[id]
+        # 近邻不足k个(或k等于行数)时索引中已经包含了该行所有的近邻
+        complete = count < self.k or self.k == self.indices.shape[0]
+        if complete or topk != -1 and topk <= self.k:
+            if topk != -1:
+                count = min(count, topk)
+            return (self.indices[id, :count],
+                    self.similarities[id, :count].astype(np.float64))
+
+        # topk超过索引的大小, 对整行重新排序
+        self._warn_resort(topk)
+        row = np.asarray(self.similarity_matrix[id], dtype=np.float64)
+        ordered = np.argsort(-row, kind="stable")
+        if self.positive_only:
+            ordered = ordered[row[ordered] > 0]
+        if topk != -1:
+            ordered = ordered[:topk]
+        return ordered, row[ordered]
+
+    def batch_neighbors(self, ids, topk=-1):
+        """批量获取前topk个近邻
+
+        Args:
+            ids : 当前用户/项目组成的数组
+            topk : 近邻数量, -1表示不限制数量
+
+        Returns:
+            (近邻下标, 近邻相似度), 形状均为(len(ids), width), 每一行依照相似度从大到小排序,
+            近邻不足width个的位置下标为-1, 相似度为0
+        """
+        assert isinstance(topk, int)
+        assert topk == -1 or topk > 0
+        ids = np.asarray(ids, dtype=np.int64)
+        complete = self.k == self.indices.shape[0] or np.all(
+            self.counts[ids] < self.k)
+        if complete or topk != -1 and topk <= self.k:
+            width = self.k if topk == -1 else min(topk, self.k)
+            return (self.indices[ids, :width],
+                    self.similarities[ids, :width].astype(np.float64))
+
+        # topk超过索引的大小, 对这些行重新排序
+        self._warn_resort(topk)
+        rows = np.asarray(self.similarity_matrix[ids], dtype=np.float64)
+        ordered = np.argsort(-rows, axis=1, kind="stable")
+        if topk != -1:
+            ordered = ordered[:, :topk]
+        sims = np.take_along_axis(rows, ordered, axis=1)
+        if self.positive_only:
+            invalid = ~(sims > 0)
+            ordered[invalid] = -1
+            sims[invalid] = 0
+        return ordered, sims
+
+    def _warn_resort(self, topk):
+        if self._warned:
+            return
+        self._warned = True
+        logger.warning(
+            f"topk={topk} is not covered by the neighbor index (k={self.k}), "
+            f"similarity rows are re-sorted at predict time; "
+            f"pass n_neighbors >= topk to fit to avoid it")
+
+
+def _top_k(block, k):
+    """取出每一行最大的k个值及其下标, 按值从大到小排序, 值相同时下标小的在前
+    """
+    n_rows, n = block.shape
+    if k < n:
+        part = np.argpartition(-block, k - 1, axis=1)[:, :k]
+    else:
+        part = np.broadcast_to(np.arange(n), (n_rows, n))
+    values = np.take_along_axis(block, part, axis=1)
+    order = np.lexsort((part, -values), axis=-1)
+    idx = np.take_along_axis(part, order, axis=1)
+    values = np.take_along_axis(values, order, axis=1)
+
+    # argpartition在第k个值有并列时任意选取, 这些行中等于第k个值的位置按下标从小到大重新选取,
+    # 大于第k个值的近邻一定都已选中且已排好序, 不需要对整行重新排序
+    kth = values[:, -1]
+    ties = np.nonzero((block >= kth[:, None]).sum(axis=1) > k)[0]
+    for r in ties:
+        n_greater = np.count_nonzero(values[r] > kth[r])
+        idx[r, n_greater:] = np.flatnonzero(block[r] == kth[r])[:k - n_greater]
+        values[r, n_greater:] = kth[r]
+    return idx, values
+
+
+def weighted_deviation(neighbors, similarities, rates, means, valid):
+    """批量计算近邻评分相对于近邻均值的偏差按相似度加权的和
+
+    Args:
+        neighbors : (batch, width)的近邻下标, -1表示没有近邻
+        similarities : (batch, width)的近邻相似度
+        rates : (batch, width)的近邻评分
+        means : 每个用户/项目的评分均值
+        valid : (batch, width)的掩码, 只统计其中为True的位置
+
+    Returns:
+        (sum(相似度 * (近邻评分 - 近邻评分均值)), sum(相似度))
+    """
+    sims = np.where(valid, similarities, 0)
+    deviation = np.where(valid, rates - means[np.maximum(neighbors, 0)], 0)
+    return (sims * deviation).sum(axis=1), sims.sum(axis=1)
@@ -0,0 +1,149 @@
+import hashlib
+import os
+import shutil
+
+import numpy as np
+from const import SIMILARITY_CACHE_DIR
+
+from utils.similarity import DEFAULT_N_NEIGHBORS, NeighborIndex
+from utils.tools import output_json
+"""
+    On-disk cache of similarity matrices and neighbor indexes
+"""
+
+SIMILARITY_CACHE_VERSION = 1  # 缓存的格式版本, 相似度的计算方式变化时递增, 旧缓存不会再被使用
+DEFAULT_CACHE_MAX_BYTES = 8 * 2**30  # 相似度缓存默认的总大小上限(字节)
+
+
+def similarity_cache_key(triad, metric, nan_symbol, kind):
+    """根据训练数据的内容计算缓存的key
+
+    Args:
+        triad : 训练数据三元组
+        metric : 相似度计算方法
+        nan_symbol : 缺失项标记
+        kind : 相似度矩阵的种类, 例如"user"/"item"
+    """
+    triad = np.ascontiguousarray(triad, dtype=np.float64)
+    sha1 = hashlib.sha1()
+    sha1.update(
+        f"{SIMILARITY_CACHE_VERSION}|{kind}|{metric}|{nan_symbol}|{triad.shape}"
+        .encode())
+    sha1.update(triad.tobytes())
+    return sha1.hexdigest()
+
+
+class SimilarityCache(object):
+    """以训练数据指纹为key的相似度矩阵缓存
+
+    同一份训练数据(例如相同density和随机种子的划分)、相同的相似度计算方法只计算一次相似度矩阵,
+    保存为.npy文件, 之后以内存映射的方式读取. 近邻索引按近邻数量分别保存在同一目录下.
+    写入新的缓存后, 总大小超过max_bytes时按最近使用时间删除最久没有使用的缓存.
+
+    Args:
+        triad : 训练数据三元组
+        metric : 相似度计算方法
+        nan_symbol : 缺失项标记
+        kind : 相似度矩阵的种类, 例如"user"/"item"
+        cache_dir : 缓存的存放目录. Defaults to SIMILARITY_CACHE_DIR.
+        max_bytes : 缓存目录的总大小上限(字节), None表示不限制. Defaults to DEFAULT_CACHE_MAX_BYTES.
+    """
+    def __init__(self,
+                 triad,
+                 metric,
+                 nan_symbol,
+                 kind,
+                 cache_dir=SIMILARITY_CACHE_DIR,
+                 max_bytes=DEFAULT_CACHE_MAX_BYTES) -> None:
+        self.key = similarity_cache_key(triad, metric, nan_symbol, kind)
+        self.cache_dir = cache_dir
+        self.dir_path = os.path.join(cache_dir, self.key)
+        self.max_bytes = max_bytes
+        self.meta = {
+            "version": SIMILARITY_CACHE_VERSION,
+            "kind": kind,
+            "metric": metric,
+            "nan_symbol": nan_symbol,
+            "n_triads": len(triad)
+        }
+
+    @property
+    def similarity_path(self):
+        return os.path.join(self.dir_path, "similarity.npy")
+
+    def similarity_matrix(self, compute):
+        """读取缓存的相似度矩阵, 缓存不存在时计算并保存
+
+        Args:
+            compute : 计算相似度矩阵的函数, 接受一个.npy文件路径作为参数,
+                可以直接将结果写入该文件(内存映射), 也可以返回相似度矩阵
+
+        Returns:
+            np.memmap: 只读的相似度矩阵
+        """
+        path = self.similarity_path
+        if os.path.isfile(path):
+            os.utime(self.dir_path)  # 记录最近使用时间
+            return np.load(path, mmap_mode="r")
+
+        os.makedirs(self.dir_path, exist_ok=True)
+        # 先写临时文件再替换, 避免多个进程同时建缓存时读到不完整的文件
+        tmp_path = f"{path}.{os.getpid()}.tmp.npy"
+        similarity = compute(tmp_path)
+        shape = similarity.shape
+        if isinstance(similarity, np.memmap) and similarity.filename == \
+                os.path.abspath(tmp_path):
+            similarity.flush()
+        else:
+            np.save(tmp_path, np.asarray(similarity, dtype=np.float64))
+        del similarity
+        os.replace(tmp_path, path)
+        output_json(dict(self.meta, shape=list(shape)),
+                    os.path.join(self.dir_path, "meta.json"))
+        self._evict()
+        return np.load(path, mmap_mode="r")
+
+    def neighbor_index(self,
+                       similarity_matrix,
+                       k=DEFAULT_N_NEIGHBORS,
+                       positive_only=False,
+                       memory_budget=None):
+        """读取缓存的近邻索引, 缓存不存在时构建并保存
+        """
+        prefix = f"neighbors-{k}" + ("-positive" if positive_only else "")
+        index = NeighborIndex.load(similarity_matrix, self.dir_path, prefix,
+                                   positive_only)
+        if index is None:
+            index = NeighborIndex.build(similarity_matrix, k, positive_only,
+                                        memory_budget)
+            os.makedirs(self.dir_path, exist_ok=True)
+            index.save(self.dir_path, prefix)
+            self._evict()
+        return index
+
+    def _evict(self):
+        """总大小超过max_bytes时, 从最久没有使用的缓存开始删除, 当前的缓存不删除
+        """
+        if self.max_bytes is None:
+            return
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            dir_path = os.path.join(self.cache_dir, key)
+            if not os.path.isdir(dir_path):
+                continue
+            try:
+                size = sum(
+                    os.path.getsize(os.path.join(dir_path, name))
+                    for name in os.listdir(dir_path))
+                entries.append((os.path.getmtime(dir_path), size, key))
+            except OSError:  # 其他进程正在删除
+                continue
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if key == self.key:
+                continue
+            shutil.rmtree(os.path.join(self.cache_dir, key),
+                          ignore_errors=True)
+            total -= size